@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Benchmark the harvester offline. Synthetic records are served by a
+    local mock server (mdh_modules/mock_server.py) and harvested using
+    MetadataHarvester, reporting records per second, peak memory (RSS) and
+    bytes received and written for each scenario.
+
+NOTES:
+    - Scenarios:
+        - 10k, 100k, 1M: number of records harvested
+        - slow: server waiting 0.5 s before each response
+        - flaky: 20 % of requests answered with 503, 5 % deleted records
+    - Each scenario is harvested in a separate process, i.e. peak RSS is
+      the peak of that harvest only. The mock server runs in the main
+      process.
+    - Responses are generated from the record number and a fixed seed,
+      the same options always give the same requests and output.
+    - Harvested records are written to a temporary directory unless
+      --outdir is given.
+
+"""
+
+import sys
+import os
+import argparse
+import json
+import logging
+import resource
+import shutil
+import tempfile
+import time
+import multiprocessing
+from mdh_modules.mock_server import MockServer
+
+SCENARIOS = {
+        '10k': {'records': 10000},
+        '100k': {'records': 100000},
+        '1M': {'records': 1000000},
+        'slow': {'records': 2000, 'delay': 0.5},
+        'flaky': {'records': 10000, 'fail': 0.2, 'deleted': 0.05},
+        }
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-s','--scenarios',dest='scenarios',default='10k',help='Comma separated list of scenarios (%s)' % ', '.join(SCENARIOS),required=False)
+    parser.add_argument('-p','--protocol',dest='protocol',default='OAI-PMH',choices=['OAI-PMH','OGC-CSW','OpenSearch'],help='Protocol to harvest',required=False)
+    parser.add_argument('-f','--format',dest='srcfmt',default='dif',choices=['dif','iso'],help='Metadata format (OAI-PMH)',required=False)
+    parser.add_argument('-n','--records',dest='records',type=int,help='Number of records, overrides the scenario',required=False)
+    parser.add_argument('--pagesize',dest='pagesize',type=int,default=100,help='Records per page',required=False)
+    parser.add_argument('--size',dest='size',type=int,default=2000,help='Approximate size of records in bytes',required=False)
+    parser.add_argument('--no-compress',dest='compress',action='store_false',help='Do not compress responses',required=False)
+    parser.add_argument('--stream',dest='stream',action='store_true',help='Harvest OAI-PMH using the streaming parser',required=False)
+    parser.add_argument('--pipeline',dest='pipeline',action='store_true',help='Harvest OAI-PMH overlapping download and writing',required=False)
+    parser.add_argument('--concurrency',dest='concurrency',type=int,default=1,help='Number of CSW and OpenSearch pages fetched in parallel',required=False)
+    parser.add_argument('-o','--outdir',dest='outdir',help='Directory to write records to, kept after the benchmark',required=False)
+    parser.add_argument('-j','--json',dest='jsonfile',help='File to append results to (JSON lines)',required=False)
+
+    args = parser.parse_args()
+
+    for scenario in args.scenarios.split(','):
+        if scenario not in SCENARIOS:
+            parser.error('Unknown scenario: %s' % scenario)
+
+    return args
+
+def run_harvest(baseURL, outdir, args, results):
+    """
+    Harvest the mock server, run in a separate process. Results are put
+    on the results queue.
+    """
+    from mdh_modules.harvest_metadata import MetadataHarvester
+    logging.basicConfig(level=logging.ERROR)
+    if args.protocol == 'OAI-PMH':
+        baseURL += '/oai'
+        request = '?verb=ListRecords&metadataPrefix='+args.srcfmt
+    elif args.protocol == 'OpenSearch':
+        baseURL += '/opensearch'
+        request = '?q=*'
+    else:
+        baseURL += '/csw'
+        request = '?SERVICE=CSW&VERSION=2.0.2&request=GetRecords'\
+                '&resultType=results'\
+                '&outputSchema=http://www.isotc211.org/2005/gmd'\
+                '&elementSetName=full'
+    mh = MetadataHarvester('benchmark', baseURL, request,
+            os.path.join(outdir, 'raw'), os.path.join(outdir, 'mmd'),
+            args.protocol, args.srcfmt, stream=args.stream,
+            pipeline=args.pipeline, concurrency=args.concurrency,
+            retries=10)
+    start_time = time.perf_counter()
+    try:
+        numRec = mh.harvest()
+        status = 'OK'
+    except Exception as e:
+        numRec = mh.numRecHarv
+        status = 'Failed: %s' % e
+    walltime = time.perf_counter()-start_time
+    results.put({'records': numRec, 'walltime': walltime,
+        'bytes_received': mh.numBytes, 'status': status,
+        # kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024})
+
+def directory_size(mydir):
+    """ Number of bytes in files below mydir """
+    mysize = 0
+    for root, dirs, files in os.walk(mydir):
+        for myfile in files:
+            mysize += os.path.getsize(os.path.join(root, myfile))
+    return mysize
+
+def run_scenario(scenario, args):
+    """ Run a single scenario, returns a dictionary of results """
+    settings = dict(SCENARIOS[scenario])
+    if args.records:
+        settings['records'] = args.records
+    myserver = MockServer(pagesize=args.pagesize, size=args.size,
+            compress=args.compress, **settings)
+    baseURL = myserver.start()
+    if args.outdir:
+        outdir = os.path.join(args.outdir, scenario)
+        shutil.rmtree(outdir, ignore_errors=True)
+    else:
+        outdir = tempfile.mkdtemp(prefix='mdharvest-benchmark-')
+    try:
+        mycontext = multiprocessing.get_context('spawn')
+        results = mycontext.Queue()
+        myprocess = mycontext.Process(target=run_harvest,
+                args=(baseURL, outdir, args, results))
+        myprocess.start()
+        myresult = results.get()
+        myprocess.join()
+        myresult['bytes_written'] = directory_size(outdir)
+    finally:
+        myserver.stop()
+        if not args.outdir:
+            shutil.rmtree(outdir, ignore_errors=True)
+    myresult.update({'scenario': scenario, 'protocol': args.protocol,
+        'format': {'OAI-PMH': args.srcfmt, 'OpenSearch': 'atom'}.get(args.protocol, 'iso'),
+        'stream': args.stream, 'pipeline': args.pipeline,
+        'concurrency': args.concurrency, 'pagesize': args.pagesize,
+        'size': args.size, 'requests': myserver.requests,
+        'failures': myserver.failures})
+    myresult['records_per_second'] = round(myresult['records']/myresult['walltime'], 1)
+    myresult['walltime'] = round(myresult['walltime'], 3)
+    myresult.update(('server_'+k, v) for k, v in settings.items())
+    return myresult
+
+def print_results(results):
+    """ Print a table of the results """
+    myformat = '%-10s %10s %10s %12s %10s %14s %14s %8s'
+    print(myformat % ('Scenario', 'Records', 'Time [s]', 'Records/s',
+        'RSS [MB]', 'Bytes in', 'Bytes written', 'Status'))
+    for res in results:
+        print(myformat % (res['scenario'], res['records'], res['walltime'],
+            res['records_per_second'], round(res['peak_rss']/2**20, 1),
+            res['bytes_received'], res['bytes_written'], res['status']))
+
+    return
+
+###########################################################
+def main(argv):
+    args = parse_arguments()
+
+    results = []
+    for scenario in args.scenarios.split(','):
+        myresult = run_scenario(scenario, args)
+        results.append(myresult)
+        if args.jsonfile:
+            with open(args.jsonfile, 'a') as myfile:
+                myfile.write(json.dumps(myresult, sort_keys=True)+'\n')
+    print_results(results)
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -12,7 +12,20 @@ UPDATED:
         Further refined.
 
 NOTES:
-    - NA
+    - Unchanged records are not rewritten by the harvester, the time the
+      record was last seen (in the record index of the raw directory) is
+      used instead of the modification time when available.
+    - CSW sources harvested incrementally are checked for removed records
+      by the harvester, listing all records.
+    - Records not changed are not seen in incremental OAI-PMH harvests
+      (from argument, the default), i.e. the time they were last seen is
+      not updated. Sources are skipped unless the last harvest saw all
+      records (complete in the harvest state, see harvest_state.py), e.g.
+      a full (--full) or selective harvest. OAI-PMH sources report deleted
+      records anyway. Use --state as for run-harvest.py if the harvest
+      state isn't kept next to the configuration file.
+    - Records set inactive are written again by the next harvest seeing
+      them, and are then active again.
 
 """
 
@@ -20,7 +33,10 @@ import sys
 import os
 import argparse
 import yaml
-from mdh_modules.harvest_metadata import setInactive,initialise_logger
+from mdh_modules.harvest_metadata import setInactiveRecord,initialise_logger
+from mdh_modules.record_index import RecordIndex, index_filename
+from mdh_modules.record_store import get_store, close_stores
+from mdh_modules.harvest_state import HarvestState, state_filename
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from datetime import datetime
@@ -32,6 +48,7 @@ def parse_arguments():
     parser.add_argument("-l","--logfile",dest="logfile", help="Log file", required=True)
     parser.add_argument("-f","--from",dest="fromTime", help="DateTime to check against, in the form YYYY-MM-DD, older files are set inactive", required=False)
     parser.add_argument('-s','--sources',dest='sources',help='Comma separated list of sources (in config) to harvest',required=False)
+    parser.add_argument('--state',dest='statefile',help='File holding the state of previous harvests, default is next to the configuration file',required=False)
 
     args = parser.parse_args()
 
@@ -53,15 +70,34 @@ def loop_directory(mylog, dir2c, dir2m, olderthan=None):
     defoutdtime = 60*60*24*7
     if olderthan is None:
         olderthan = datetime.now().timestamp()-defoutdtime
-    for fn in os.listdir(dir2c):
+    # Time each record was last seen, if indexed
+    lastseen = {}
+    myindex = None
+    if os.path.exists(index_filename(dir2c)):
+        myindex = RecordIndex(index_filename(dir2c))
+        lastseen = myindex.last_seen()
+    mmdstore = get_store(dir2m)
+    for fn, myfile in get_store(dir2c).paths():
         if fn.endswith('.xml'):
             # Check against minimum check
             # TODO: Make configureable and add check from command line
-            lastmtime = os.path.getmtime('/'.join([dir2c,fn]))
+            if myfile in lastseen:
+                lastmtime = datetime.fromisoformat(lastseen[myfile]).timestamp()
+            elif os.path.exists(myfile):
+                lastmtime = os.path.getmtime(myfile)
+            else:
+                # Packed records not indexed, nothing to check against
+                mylog.warning("No time found for %s, skipping", fn)
+                continue
             if lastmtime < olderthan:
-                mmdid = fn.rstrip('.xml')
+                # MMD files are named as the raw files
                 mylog.info("File %s will be set inactive", fn)
-                setInactive(dir2m, mmdid, mylog)
+                setInactiveRecord(mmdstore, fn, mylog)
+                # Written again (and active) if harvested again
+                if myindex != None:
+                    myindex.clear_checksum(myfile)
+    if myindex != None:
+        myindex.close()
 
     return
 
@@ -91,16 +127,33 @@ def main(argv):
     with open(args.cfgfile, 'r') as ymlfile:
         cfg = yaml.full_load(ymlfile)
 
+    # Harvest state, to check that the last harvest saw all records
+    if args.statefile:
+        statefile = args.statefile
+    else:
+        statefile = state_filename(args.cfgfile)
+    mylog.info("Using harvest state in: %s", statefile)
+    state = HarvestState(statefile)
+
     # Each section is a data centre to harvest
     for section in cfg:
         if args.sources:
             if section not in mysources:
                 continue
+        mystate = state.get(section)
+        mycomplete = mystate.get('complete')
+        if mycomplete == None and 'last_start' in mystate:
+            # State of earlier versions, OAI-PMH is harvested incrementally
+            mycomplete = cfg[section].get('protocol') != 'OAI-PMH'
+        if mycomplete == False:
+            mylog.warning("Last harvest of %s didn't see all records, skipping", section)
+            continue
         mylog.info('\n')
         mylog.info('====')
         mylog.info('Checking: %s for old files',section)
         mylog.info('Looping harvested files in: %s', cfg[section]['raw'])
         loop_directory(mylog, cfg[section]['raw'],cfg[section]['mmd'], olderthan)
+    close_stores()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
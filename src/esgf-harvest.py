@@ -4,9 +4,13 @@
 import os
 import sys
 import requests
+from mdh_modules.http_client import HarvestClient
 import json
 import lxml.etree as ET
 
+# Shared HTTP client, connections are reused between requests
+myclient = HarvestClient()
+
 def check_directories(mydir):
     if not os.path.isdir(mydir):
         try:
@@ -54,7 +58,7 @@ def createparent(myurl):
     # Get the parent documents we are using tio create parent MMD records. These are missing temporal and spatial constraints, but still are the best starting point.
     print(myurl)
     try:
-        r = requests.get(myurl)
+        r = myclient.get(myurl)
     except Exception as e:
         print('Something failed when checking parent records', e)
         raise
@@ -315,7 +319,7 @@ for item in sources:
     myrequest = '&source_id='+item
     searchrequest = searchbase+myrequest
     print('>>>', searchrequest)
-    r = requests.get(searchrequest)
+    r = myclient.get(searchrequest)
     myjson = r.json()
     numfound = myjson['response']['numFound']
     numrec = parserecords(destdir, item, myjson)
@@ -325,7 +329,7 @@ for item in sources:
         myrequest = '&source_id='+item+'&offset='+str(recproc)
         searchrequest = searchbase+myrequest
         print('>>>', searchrequest)
-        r = requests.get(searchrequest)
+        r = myclient.get(searchrequest)
         myjson = r.json()
         #print(myjson['responseHeader'])
         numret = myjson['responseHeader']['params']['rows']
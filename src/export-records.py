@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Export the records of the raw and MMD directories of the sources in a
+    configuration file to plain directories, one file per record. This
+    gives files for tools not using mdh_modules/record_store.py, e.g. when
+    records are kept in the packed layout.
+
+NOTES:
+    - Records are written to <outdir>/<source>/<raw|mmd>/, in the flat
+      layout unless --layout is given.
+    - Existing files are overwritten.
+
+"""
+
+import sys
+import os
+import argparse
+import yaml
+from mdh_modules.harvest_metadata import initialise_logger
+from mdh_modules.record_store import get_store, close_stores, DirectoryStore
+import logging
+from logging.handlers import TimedRotatingFileHandler
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-c","--config",dest="cfgfile", help="Configuration file containing endpoints to harvest", required=True)
+    parser.add_argument("-l","--logfile",dest="logfile", help="Log file", required=True)
+    parser.add_argument("-o","--outdir",dest="outdir", help="Directory to export records to", required=True)
+    parser.add_argument('-s','--sources',dest='sources',help='Comma separated list of sources (in config) to export',required=False)
+    parser.add_argument('--layout',dest='layout',choices=['flat','sharded'],default='flat',help='Layout of the directories exported',required=False)
+    parser.add_argument('--dirs',dest='dirs',default='mmd',help='Comma separated list of directories to export (raw, mmd)',required=False)
+
+    args = parser.parse_args()
+
+    return args
+
+def export_directory(mydir, outdir, layout, mylog):
+    """ Export the records of a directory, returns the number exported """
+    if not os.path.isdir(mydir):
+        mylog.warning('%s does not exist, skipping', mydir)
+        return 0
+    mystore = get_store(mydir)
+    outstore = DirectoryStore(outdir, layout)
+    counter = 0
+    for name, mydata in mystore.items():
+        outstore.write(name, mydata)
+        counter += 1
+    mylog.info('Exported %d records from %s to %s', counter, mydir, outdir)
+
+    return counter
+
+###########################################################
+def main(argv):
+    # Parse command line arguments
+    try:
+        args = parse_arguments()
+    except:
+        raise SystemExit('Command line arguments didn\'t parse correctly.')
+
+    if args.sources:
+        mysources = args.sources.split(',')
+
+    # Set up logging
+    mylog = initialise_logger(args.logfile,'export-records')
+    mylog.info('\n==========\nConfiguration of logging is finished.')
+
+    # Read config file
+    mylog.info("Reading configuration from: %s", args.cfgfile)
+    with open(args.cfgfile, 'r') as ymlfile:
+        cfg = yaml.full_load(ymlfile)
+
+    for section in cfg:
+        if args.sources:
+            if section not in mysources:
+                continue
+        for name in args.dirs.split(','):
+            export_directory(cfg[section][name],
+                    os.path.join(args.outdir, section, name), args.layout,
+                    mylog)
+    close_stores()
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -49,6 +49,7 @@ import logging
 import vocab.ResearchInfra
 from logging.handlers import TimedRotatingFileHandler
 from mdh_modules.harvest_metadata import initialise_logger
+from mdh_modules.record_store import get_store, close_stores
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -82,11 +83,14 @@ def parse_arguments():
 
 class LocalCheckMMD():
     def __init__(self, logname, section, mmd_file, bounding, parameters, mycollection,
-            project, enrich, rivocab):
+            project, enrich, rivocab, store=None):
         self.logger = logging.getLogger('.'.join([logname,'LocalCheckMMD']))
         self.logger.info('Creating an instance of LocalCheckMMD')
         self.section = section
         self.mmd_file = mmd_file
+        # If a store (see record_store) is given, mmd_file is the name of
+        # the record in the store
+        self.store = store
         self.bbox = bounding
         self.params = parameters
         self.coll = mycollection
@@ -318,7 +322,10 @@ class LocalCheckMMD():
         mmd_file = self.mmd_file
         tmpcoll = []
         tmpcoll.append(self.coll)
-        tree = ET.ElementTree(file=mmd_file)
+        if self.store != None:
+            tree = self.store.parse(mmd_file)
+        else:
+            tree = ET.ElementTree(file=mmd_file)
         root = tree.getroot()
         mynsmap = {'mmd':'http://www.met.no/schema/mmd'}
         #print ET.tostring(root)
@@ -459,7 +466,10 @@ class LocalCheckMMD():
                                     ET.XML("<mmd:collection xmlns:mmd='http://www.met.no/schema/mmd'>"+item+"</mmd:collection>"""))
         #tree = ET.ElementTree(mycollection)
         ET.indent(root, space="  ")
-        tree.write(mmd_file, pretty_print=True)
+        if self.store != None:
+            self.store.write(mmd_file, ET.tostring(tree, pretty_print=True))
+        else:
+            tree.write(mmd_file, pretty_print=True)
 
         return mymatch
 
@@ -559,7 +569,8 @@ def main(argv):
 
         # Find files to process
         try:
-            myfiles = os.listdir(cfg[section]['mmd'])
+            mystore = get_store(cfg[section]['mmd'])
+            myfiles = mystore.names()
         except os.error:
             mylog.error('Couldn\'t find files to process: %s', os.error)
             sys.exit(1)
@@ -579,7 +590,7 @@ def main(argv):
             if myfile.endswith(".xml"):
                 mylog.info('Processing file %d, %s', i, myfile)
                 i += 1
-                file2check = LocalCheckMMD('filter_mmd_records', section,s.join((cfg[section]['mmd'],myfile)), bounding, parameters, collection, project, myenrich, vocab.ResearchInfra.RI)
+                file2check = LocalCheckMMD('filter_mmd_records', section, myfile, bounding, parameters, collection, project, myenrich, vocab.ResearchInfra.RI, mystore)
                 if file2check.check_mmd():
                     mylog.info("Success")
                     filtered += 1
@@ -588,6 +599,7 @@ def main(argv):
         if fullenrich is not None:
             mylog.info('Enhancement expected for %s = %s, Enhancement obtained %s', section, expected_updates, filtered)
 
+    close_stores()
     mylog.info('Processing finished.')
 
 
@@ -25,6 +25,7 @@ import pandas as pd
 import vocab.ControlledVocabulary
 import vocab.ResearchInfra
 import requests
+from mdh_modules.http_client import HarvestClient
 import time
 import lxml.etree as ET
 import urllib.request as ul
@@ -38,6 +39,9 @@ import datetime as dt
 import gc
 import re
 
+# Shared HTTP client, connections are reused between requests
+myclient = HarvestClient()
+
 def extract_metadata(url, delayedloading):
     """
     Extract metadata from webpage. Using requests_html since NSF ADC is using Javascript to render pages...
@@ -95,7 +99,7 @@ def pangaeaapicall(url):
 
     myapi = url+"?format=metadata_jsonld"
     print('>>> my api call: ', myapi)
-    mypage = requests.get(myapi)
+    mypage = myclient.get(myapi)
     print('Response code: ', mypage.status_code)
     if mypage.status_code == 200:
         print('Processing page... ')
@@ -104,7 +108,7 @@ def pangaeaapicall(url):
         #print('headers',mypage.headers)
         #print('wait')
         time.sleep(int(mypage.headers['Retry-After']))
-        mypage = requests.get(myapi)
+        mypage = myclient.get(myapi)
         print('Response code: ', mypage.status_code)
         metadata = mypage.json()
         #print(metadata)
@@ -121,7 +125,7 @@ def download_metadata_xml(url, dstdir):
     try:
         filename = url.split('/')[-1]+'.xml'
         file_path = os.path.join(dstdir, filename)
-        response = requests.get(url+'.xml')
+        response = myclient.get(url+'.xml')
         if response.status_code == 200:
             with open(file_path, 'wb') as file:
                 file.write(response.content)
@@ -147,7 +151,7 @@ def niozschemaextract(mybatch):
             continue
         print('>>>> ',el)
         print(''.join([el,'.json']))
-        mypage = requests.get(''.join([el,'.json']))
+        mypage = myclient.get(''.join([el,'.json']))
         if mypage.status_code != 200:
             print('Something went wrong accessing the file over internet...')
         print(mypage.json())
@@ -164,7 +168,7 @@ def ccadiapicall(url, dstdir):
     while mystatus == 200:
         myapi = url+"?page="+str(page)
         print('>>> my api call: ', myapi)
-        mypage = requests.get(myapi)
+        mypage = myclient.get(myapi)
         print('Response code: ', mypage.status_code)
         if mypage.status_code == 200:
             print('Processing page... ', page)
@@ -205,7 +209,7 @@ def traversesite(url, dstdir, delayedloading, lastmodday):
 
     # Read sitemap or sitemapindex
     print('Reading sitemap or similar...')
-    mypage = requests.get(url)
+    mypage = myclient.get(url)
     sitefile = mypage.content
     mysoup = bs(sitefile, features="lxml")
     #check if this is a list of sitemaps
@@ -215,7 +219,7 @@ def traversesite(url, dstdir, delayedloading, lastmodday):
         list_sitemaps = [i.text for i in mysoup.find_all('loc')]
         news = []
         for sitemap in list_sitemaps:
-            mypage = requests.get(sitemap)
+            mypage = myclient.get(sitemap)
             sitefile = mypage.content
             mysoup = bs(sitefile, features="lxml")
             if lastmodday:
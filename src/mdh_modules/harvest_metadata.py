@@ -3,23 +3,33 @@
 Used by run_harvest.pyUsed by run_harvest.py
 
 COMMENTS (for further development):
-    - Rewrite to lxml started for OpenSearch
-    - Rename dom elements when completed, and remove DOM requirement...
+    - Rename dom elements, all protocols are parsed using lxml now...
     - Rename file to avoid using dash...
     - self-numRecHarv is incorrect when harvest fails
 """
 
 import urllib.request as ul
-from urllib.parse import urlencode, quote_plus
-import ssl
-from xml.dom.minidom import parseString # To be removed
+from urllib.parse import urlencode, quote_plus, quote, urlsplit, urlunsplit, parse_qsl
 import codecs
 import sys
 import os
 import getopt
-from datetime import datetime
+from datetime import datetime, timezone
 import lxml.etree as ET
 import logging
+import logging.handlers
+import threading
+import queue
+import time
+import hashlib
+import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mdh_modules.http_client import HarvestClient, DEFAULT_TIMEOUT, DEFAULT_RETRIES, decode_content
+from mdh_modules.record_index import RecordIndex, index_filename, changed_filename
+from mdh_modules.record_formats import FORMATS, NAMESPACES, get_format
+from mdh_modules.record_store import get_store
+from mdh_modules.mmd_transform import get_mmdid
+from mdh_modules.transform_manifest import mark_inactive
 
 def parse_cfg(cfgfile):
     # Read config file
@@ -34,7 +44,7 @@ def initialise_logger(outputfile, name):
         raise IOError("Missing input parameters")
     # Check that logfile exists
     logdir = os.path.dirname(outputfile)
-    if not os.path.exists(logdir):
+    if logdir and not os.path.exists(logdir):
         try:
             os.makedirs(logdir)
         except:
@@ -71,19 +81,64 @@ def check_directories(cfg):
                    return(2)
     return(0)
 
+CSW_NAMESPACE = 'http://www.opengis.net/cat/csw/2.0.2'
+
+def update_query(URL, params):
+    """
+    Set parameters (dictionary) in the query of URL. Existing parameters
+    are replaced, names are compared case insensitive as in OGC services.
+    """
+    myurl = urlsplit(URL)
+    mynames = [x.lower() for x in params]
+    myquery = [(k, v) for k, v in parse_qsl(myurl.query, keep_blank_values=True)
+            if k.lower() not in mynames]
+    myquery += list(params.items())
+    return urlunsplit(myurl._replace(query=urlencode(myquery, safe=':/')))
+
+def recordbyid_url(URL):
+    """
+    Create the CSW GetRecordById request (without id) corresponding to a
+    GetRecords request, keeping service, version and output schema.
+    """
+    myurl = urlsplit(URL)
+    myquery = [(k, v) for k, v in parse_qsl(myurl.query, keep_blank_values=True)
+            if k.lower() in ['service', 'version', 'outputschema', 'elementsetname']]
+    myquery.append(('request', 'GetRecordById'))
+    return urlunsplit(myurl._replace(query=urlencode(myquery, safe=':/')))
+
+def sanitise_id(myid):
+    """
+    Create the file name (without extension) used for a record identifier
+    """
+    myid = myid.replace('/','-')
+    myid = myid.replace(':','-')
+    myid = myid.replace('.','-')
+    return myid
+
 def setInactive(mmdDir, mmdid, mylog):
 
     # Create filename from id
-    mmdfile = '/'.join([mmdDir, mmdid.replace('.','_')+'.xml'])
+    mmdstore = get_store(mmdDir)
     #print('>>>>>>>>>>', mmdfile)
 
+    setInactiveRecord(mmdstore, mmdid.replace('.','_')+'.xml', mylog)
+
+    return
+
+def setInactiveRecord(mmdstore, name, mylog):
+    """
+    Set the MMD record name in mmdstore (see record_store) inactive.
+    """
+
     # Check if file exists
-    if os.path.exists(mmdfile):
+    mmdfile = mmdstore.path(name)
+    if mmdstore.exists(name):
         mylog.info('Found file: %s', mmdfile)
         try:
-            myxml = ET.parse(mmdfile)
+            myxml = mmdstore.parse(name)
         except Exception as e:
             mylog.warn('Could not properly parse: %s', mmdfile)
+            return
         myroot = myxml.getroot()
         mystat = myroot.find('mmd:metadata_status', namespaces=myroot.nsmap)
         if mystat is None:
@@ -92,18 +147,32 @@ def setInactive(mmdDir, mmdid, mylog):
         if mystat.text == 'Active':
             mystat.text = 'Inactive'
             mylog.info('%s is set inactive', mmdfile)
-            myxml.write(mmdfile, pretty_print=True)
+            mmdstore.write(name, ET.tostring(myxml, pretty_print=True))
+            mark_inactive(mmdstore.directory, name)
     else:
         mylog.info('No existing file found, probably already deleted.')
 
     return
 
+class ResumptionTokenError(IOError):
+    """
+    Raised when an OAI-PMH endpoint rejects a resumptionToken, e.g. when
+    it has expired.
+    """
+    pass
+
 class MetadataHarvester(object):
     """ 
     Creates metadata-harvester object with methods for harvesting and writing
     """
     def __init__(self, logname, baseURL, records, outputDir, mmdDir, hProtocol, 
-            srcfmt = None, username=None, pw=None):
+            srcfmt = None, username=None, pw=None, stream=False,
+            pipeline=False, writers=4, prefetch=2, concurrency=1,
+            timeout=DEFAULT_TIMEOUT, verify=False, checkpoint=None,
+            resume=None, retries=DEFAULT_RETRIES, rate=None, burst=1,
+            selective=False, metrics=None, capture=None, replay=None,
+            layout=None, modified=None, batchsize=50, transform=None,
+            archive=True, settings=None):
         """ set variables in class """
         self.logger = logging.getLogger('.'.join([logname,'MetadataHarvester']))
         self.logger.info('Creating an instance of LocalCheckMMD')
@@ -111,20 +180,115 @@ class MetadataHarvester(object):
         self.records = records
         self.outputDir = outputDir
         self.mmdDir = mmdDir
+        # Layout of new raw and MMD directories, see record_store
+        self.layout = layout
         self.hProtocol = hProtocol
         self.srcfmt = srcfmt
         self.username = username
         self.pw = pw
+        self.stream = stream
+        self.pipeline = pipeline
+        self.writers = writers
+        self.prefetch = prefetch
+        self.concurrency = concurrency
         self.numRecHarv = 0
+        self.numBytes = 0
+        # Set if all records at the source were seen in the last harvest,
+        # i.e. the time records were last seen is up to date
+        self.complete = False
+        self.lock = threading.Lock()
+        # TLS verification is optional per source
+        self.client = HarvestClient(timeout=timeout, verify=verify,
+                retries=retries, rate=rate, burst=burst, logger=self.logger,
+                capture=capture, replay=replay)
+        # Function called with the paging position after each page written
+        self.checkpoint = checkpoint
+        # Paging position to continue from, as given to checkpoint
+        self.resume = resume
+        self.selective = selective
+        # Records per GetRecordById request (selective CSW harvest)
+        self.batchsize = batchsize
+        # Transformation to MMD (MMDTransform) applied to new and changed
+        # records while harvesting, see mmd_transform
+        self.transform = transform
+        # Checksum of the settings of the transformation, unchanged records
+        # transformed with other settings are transformed again, see
+        # transform_manifest.transform_settings
+        self.settings = settings
+        # Writing of raw records: True, 'async' (by a separate thread) or
+        # False
+        self.archive = archive
+        self.archiveQueue = None
+        # Harvest CSW records modified since this date or time (ISO 8601)
+        # only, reset if the provider doesn't support it
+        self.modified = modified
+        # Index of records harvested, open while harvesting
+        self.index = None
+        # Stores of raw and MMD records, see record_store
+        self.store = None
+        self.mmdStore = None
+        # Records deleted in the current page
+        self.deleted = []
+        # Files written (new or changed records) and start of the harvest
+        self.changed = []
+        self.harvestTime = None
+        # Format of the records harvested, see record_formats
+        self.recordFormat = None
+        # Metrics of the source (SourceMetrics), see harvest_metrics
+        self.metrics = metrics
 
     def harvest(self):
         """ 
         Inititates harvester. Chooses strategy depending on
         harvesting  protocol
         """
+        self.index = RecordIndex(index_filename(self.outputDir))
+        self.store = get_store(self.outputDir, self.layout)
+        self.mmdStore = get_store(self.mmdDir, self.layout)
+        self.harvestTime = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self.changed = []
+        if self.archive == 'async':
+            self.archiveQueue = queue.Queue(maxsize=1000)
+            myarchiver = threading.Thread(target=self.archiveRecords,
+                    name='archiver', daemon=True)
+            myarchiver.start()
+        try:
+            return self.harvestRecords()
+        finally:
+            if self.archiveQueue != None:
+                self.archiveQueue.put(None)
+                myarchiver.join()
+                self.archiveQueue = None
+            self.index.close()
+            self.index = None
+            self.store.commit()
+            self.mmdStore.commit()
+            self.writeChanged()
+
+    def writeChanged(self):
+        """
+        Write the list of files written in this harvest, i.e. new or
+        changed records, for later stages to consume.
+        """
+        if not os.path.isdir(self.outputDir):
+            return
+        myfilename = changed_filename(self.outputDir)
+        with open(myfilename+'.tmp', 'w') as myfile:
+            for filename in sorted(self.changed):
+                myfile.write(filename+'\n')
+        os.replace(myfilename+'.tmp', myfilename)
+        self.logger.info("\n\tNumber of files new or changed: %d", len(self.changed))
+        return
+
+    def harvestRecords(self):
+        """
+        Harvest records according to protocol.
+        """
         baseURL, records, hProtocol, uname, pw = self.baseURL, self.records, self.hProtocol, self.username, self.pw
 
         self.numRecHarv = 0
+        self.numBytes = 0
+        self.complete = False
         if hProtocol == 'OAI-PMH':
             # Could/should be more sophistiated by means of deciding url
             # properties
@@ -134,78 +298,29 @@ class MetadataHarvester(object):
             getRecordsURL = str(baseURL + records)
             self.logger.info("Harvesting metadata from: \n\tURL: %s \n\tprotocol: %s \n", getRecordsURL,hProtocol)
             start_time = datetime.now()
+            self.recordFormat = get_format(self.srcfmt)
+            if self.recordFormat == None:
+                raise Exception("Metadata format not supported yet.")
 
-            # Initial phase
-            self.logger.info("\n\tURL request: %s",getRecordsURL)
-            myxml = self.harvestContent(getRecordsURL)
-            if myxml != None:
-                if "dif" in self.srcfmt:
-                    self.oaipmh_writeDIFtoFile(myxml)
-                elif "iso" in self.srcfmt:
-                    self.oaipmh_writeISOtoFile(myxml)
-                elif "rdf" in self.srcfmt:
-                    # Probably should discuss keyword, rdf is quite wide but is used by several for DCAT...
-                    self.oaipmh_writeDCATtoFile(myxml)
+            resumptionToken = None
+            if self.resume:
+                resumptionToken = self.resume.get('resumptionToken')
+                self.logger.info("Resuming harvest from resumptionToken: %s", resumptionToken)
+            try:
+                if self.selective:
+                    self.oaipmh_harvestSelective(getRecordsURL)
                 else:
-                    raise Exception("Metadata format not supported yet.")
-            else:
-                self.logger.error("Server is not responding properly: %s", myxml)
-                raise IOError("Server to harvest is not responding properly")
-            pageCounter = 1
-            resumptionToken = myxml.find('.//{*}resumptionToken')
-            if resumptionToken.text == None or resumptionToken.text == '0':
-                self.logger.info("Nothing more to do")
-                resumptionToken = None
-            else:
-                resumptionToken = resumptionToken.text
-
-            self.logger.info("Resumption token found: %s",resumptionToken)
-
-            """
-            Manage resumptionToken, i.e. segmentation of results in pages
-            """
-            while resumptionToken != None:
-                self.logger.info("\n\tHandling resumptionToken number: %d", pageCounter)
-                # create resumptionToken URL parameter
-                #resumptionToken = urlencode({'resumptionToken':resumptionToken})
-                resumptionToken = 'resumptionToken='+resumptionToken
-                # Ideally this should be handled more smooth
-                resumptionTokenSpecialTreatment = ['geonetwork', 'eu-interact', 'nilu']
-                #if 'geonetwork' in baseURL:
-                if '?' in baseURL:
-                    '''
-                    Handling pycsw OAI-PMH at NILU (else NILU will trigger next) newest end point
-                    '''
-                    getRecordsURLLoop = str(getRecordsURL+'&'+resumptionToken)
-                elif any(x in baseURL for x in resumptionTokenSpecialTreatment):
-                    getRecordsURLLoop = str(baseURL+'?verb=ListRecords&'+resumptionToken)
-                else:
-                    getRecordsURLLoop = str(getRecordsURL+'&'+resumptionToken)
-                self.logger.info("\n\tURL request: %s",getRecordsURLLoop)
-                #print(type(getRecordsURLLoop))
-                myxml = self.harvestContent(getRecordsURLLoop)
-                if myxml != None:
-                    if "dif" in self.srcfmt:
-                        self.oaipmh_writeDIFtoFile(myxml)
-                    elif "iso" in self.srcfmt:
-                        self.oaipmh_writeISOtoFile(myxml)
-                    elif "rdf" in self.srcfmt:
-                        self.oaipmh_writeDCATtoFile(myxml)
-                    else:
-                        raise Exception("Metadata format not supported yet.")
-                else:
-                    self.logger.info("myxml = %s, for page %s", str(myxml), str(pageCounter))
-
-                resumptionToken = myxml.find('.//{*}resumptionToken')
-                if resumptionToken != None:
-                    self.logger.info("Resumption token found: %s",resumptionToken)
-                    if resumptionToken.text == '0':
-                        resumptionToken = None
-                    else:
-                        resumptionToken = resumptionToken.text
-
-                pageCounter += 1
+                    self.oaipmh_harvestAll(getRecordsURL, resumptionToken)
+            except ResumptionTokenError as e:
+                if resumptionToken == None:
+                    raise
+                # Records written so far are kept, the request itself is
+                # bounded by the from argument of the interrupted harvest
+                self.logger.warning("resumptionToken is no longer valid (%s), restarting from first page", e)
+                self.oaipmh_harvestAll(getRecordsURL)
 
+            # Records not changed since from are not seen
+            self.complete = 'from=' not in getRecordsURL
             self.logger.info("Harvesting completed")
             self.logger.info("Harvesting took: %s [hh:mm:ss]", str(datetime.now()-start_time))
             self.logger.info("Number of records successfully harvested: %d", self.numRecHarv)
@@ -214,13 +329,49 @@ class MetadataHarvester(object):
             getRecordsURL = str(baseURL + records)
             self.logger.info("Harvesting metadata from: \n\tURL: %s \n\tprotocol: %s \n" % (getRecordsURL,hProtocol))
             start_time = datetime.now()
-            dom = self.harvestContent(getRecordsURL)
+            self.recordFormat = FORMATS['csw-iso']
+            fullURL = getRecordsURL
+            if self.selective:
+                if self.ogccsw_harvestSelective(fullURL):
+                    self.complete = True
+                    self.logger.info("Harvesting completed")
+                    self.logger.info("\n\tHarvesting took: %s [h:mm:ss]", str(datetime.now()-start_time))
+                    self.logger.info("\n\tNumber of records successfully harvested: %d", self.numRecHarv)
+                    return(self.numRecHarv)
+                self.logger.warning("Listing of records failed, falling back to full harvest")
+            if self.resume and self.resume.get('startposition'):
+                self.logger.info("Resuming harvest from startposition: %s", self.resume['startposition'])
+                startposition = '&startposition='+str(self.resume['startposition'])
+            else:
+                startposition = ''
+            dom = cswHeader = None
+            if self.modified:
+                # Incremental harvest, falling back to a full harvest if
+                # the constraint is not supported
+                self.logger.info("Harvesting records modified since %s", self.modified)
+                getRecordsURL = update_query(fullURL, {
+                    'constraintLanguage': 'CQL_TEXT',
+                    'constraint_language_version': '1.1.0',
+                    'constraint': "Modified >= '%s'" % self.modified})
+                mystats = {'request': 'GetRecords'}
+                dom = self.harvestContent(getRecordsURL+startposition, stats=mystats)
+                if dom != None:
+                    cswHeader = dom.find('csw:SearchResults',
+                            namespaces={'csw':CSW_NAMESPACE})
+                if cswHeader == None:
+                    self.logger.warning("Constraint on Modified not supported, falling back to full harvest")
+                    self.modified = None
+                    getRecordsURL = fullURL
+                    startposition = ''
+            if cswHeader == None:
+                mystats = {'request': 'GetRecords'}
+                dom = self.harvestContent(getRecordsURL+startposition, stats=mystats)
             if dom == None:
                 self.logger.error("Server is not responding properly, skipping this provider...")
                 #raise IOError("Server to harvest is not responding properly")
                 return
             cswHeader = dom.find('csw:SearchResults',
-                    namespaces={'csw':'http://www.opengis.net/cat/csw/2.0.2'})
+                    namespaces={'csw':CSW_NAMESPACE})
             if cswHeader == None:
                 self.logger.error("Could not parse header response, skipping this provider...")
                 return
@@ -229,20 +380,37 @@ class MetadataHarvester(object):
             self.numRecsReturned = int(cswHeader.get('numberOfRecordsReturned'))
             #print('>>>',numRecsFound,nextRec, self.numRecsReturned)
             if dom != None:
-                self.ogccsw_writeCSWISOtoFile(dom)
-            if nextRec > 0:
-                while nextRec < numRecsFound:
+                self.writeRecords(dom, mystats)
+                if nextRec > 0:
+                    self.saveCheckpoint(startposition=nextRec)
+            if nextRec > 0 and self.concurrency > 1:
+                if not self.ogccsw_harvestParallel(getRecordsURL, nextRec, numRecsFound):
+                    # Records of pages missing would not be requested again
+                    # in the next incremental harvest
+                    self.logger.error("Harvest is incomplete, resume to continue")
+                    return
+            elif nextRec > 0:
+                while nextRec <= numRecsFound:
                     getRecordsURLNew = getRecordsURL
                     getRecordsURLNew += '&startposition='
                     getRecordsURLNew += str(nextRec)
-                    dom = self.harvestContent(getRecordsURLNew)
+                    mystats = {'request': 'GetRecords'}
+                    dom = self.harvestContent(getRecordsURLNew, stats=mystats)
                     cswHeader = dom.find('csw:SearchResults',
                             namespaces={'csw':'http://www.opengis.net/cat/csw/2.0.2'})
                     nextRec =  int(cswHeader.get('nextRecord'))
                     self.numRecsReturned = int(cswHeader.get('numberOfRecordsReturned'))
-                    self.ogccsw_writeCSWISOtoFile(dom)
+                    self.writeRecords(dom, mystats)
                     if nextRec == 0:
                         break
+                    self.saveCheckpoint(startposition=nextRec)
+
+            # Records not modified are not seen in an incremental
+            # harvest, check which records are still available
+            if self.modified:
+                self.complete = self.ogccsw_checkRemoved(fullURL)
+            else:
+                self.complete = True
 
             self.logger.info("Harvesting completed")
             self.logger.info("\n\tHarvesting took: %s [h:mm:ss]", str(datetime.now()-start_time))
@@ -250,38 +418,45 @@ class MetadataHarvester(object):
 
         elif hProtocol == "OpenSearch":
             getRecordsURL = str(baseURL + records)
-            self.logger.info("Harvesting metadata from: \n\tURL: %s \n\tprotocol: %s \n", (getRecordsURL,hProtocol))
+            self.logger.info("Harvesting metadata from: \n\tURL: %s \n\tprotocol: %s \n", getRecordsURL,hProtocol)
             start_time = datetime.now()
+            self.recordFormat = FORMATS['opensearch']
 
-            dom = self.harvestContent(getRecordsURL,credentials=True,uname=uname,pw=pw)
-            if dom != None:
-                self.openSearch_writeENTRYtoFile(dom)
-
-            # get all results by iteration
-            tree = ET.fromstring(dom.toxml())
-            nsmap = tree.nsmap
-            default_ns = nsmap.pop(None)
-
-            totalResults = int(tree.xpath('./opensearch:totalResults',namespaces=nsmap)[0].text)
-            startIndex = int(tree.xpath('./opensearch:startIndex',namespaces=nsmap)[0].text)
-            itemsPerPage = int(tree.xpath('./opensearch:itemsPerPage',namespaces=nsmap)[0].text)
+            mystats = {'request': 'search'}
+            dom = self.harvestContent(getRecordsURL,credentials=True,uname=uname,pw=pw,stats=mystats)
+            if dom == None:
+                self.logger.error("Server is not responding properly, skipping this provider...")
+                return
+            # Paging is known from the first page
+            try:
+                totalResults = int(dom.findtext('opensearch:totalResults', namespaces=NAMESPACES))
+                itemsPerPage = int(dom.findtext('opensearch:itemsPerPage', namespaces=NAMESPACES))
+            except (TypeError, ValueError):
+                self.logger.error("Could not parse paging information, harvesting first page only")
+                totalResults = itemsPerPage = 0
+            self.writeRecords(dom, mystats)
 
             current_results = itemsPerPage
+            if self.resume and self.resume.get('start'):
+                self.logger.info("Resuming harvest from start: %s", self.resume['start'])
+                current_results = max(current_results, int(self.resume['start']))
 
-            # looping through the rest of the results updating start and rows values
-            if totalResults > itemsPerPage:
+            # Fetch the rest of the results updating start and rows values
+            if itemsPerPage > 0 and current_results < totalResults:
                 self.logger.info("Could not display all results on single page.  Starts iterating...")
-            while current_results < totalResults:
-                self.logger.info("\n\n\tHandling results (%s - %s) / %s" %(current_results, current_results + itemsPerPage,
-                            totalResults))
-                from_to = "?start=%s&rows=%s&" % (current_results,itemsPerPage)
-                getRecordsURLLoop = str(baseURL + from_to + records[1:])
-                dom = self.harvestContent(getRecordsURLLoop,credentials=True,uname=uname,pw=pw)
-                if dom != None:
-                    self.openSearch_writeENTRYtoFile(dom)
-                current_results += itemsPerPage
+                self.saveCheckpoint(start=current_results)
+                positions = list(range(current_results, totalResults, itemsPerPage))
+                def pageURL(position):
+                    from_to = "?start=%s&rows=%s&" % (position,itemsPerPage)
+                    return str(baseURL + from_to + records[1:])
+                if not self.harvestParallel(positions, pageURL, 'search', 'start',
+                        credentials=True):
+                    self.logger.error("Harvest is incomplete, resume to continue")
+                    return
 
+            self.complete = True
             self.logger.info("\n\nHarvesting took: %s [h:mm:ss]\n",  str(datetime.now()-start_time))
+            self.logger.info("\n\tNumber of records successfully harvested: %d", self.numRecHarv)
 
         else:
             self.logger.error('Protocol %s is not accepted.', hProtocol)
@@ -289,362 +464,870 @@ class MetadataHarvester(object):
 
         return(self.numRecHarv)
 
-    def openSearch_writeENTRYtoFile(self,dom):
-        """ Write OpenSearch ENTRY elements in fom to file"""
-        self.logger.info("Writing OpenSearch ENTRY metadata elements to disk... ")
-
-        entries = dom.getElementsByTagName('entry')
-        self.logger.info("\tFound %d ENTRY elements.", entries.length)
-        counter = 1
-        has_fname = False
-        for entry in entries:
-            # Depending on usage; choose naming convention
-            fname = entry.getElementsByTagName('title')[0].childNodes[0].nodeValue
-            if fname != None:
-                has_fname = True
-            """
-            # Use UUID as naming convention
-            str_elements = entry.getElementsByTagName('str')
-            for s in reversed(str_elements):
-                if s.getAttribute('name') == 'uuid':
-                    fname = s.childNodes[0].nodeValue
-                    has_fname = True
-                    break;
-            """
-            if has_fname:
-                sys.stdout.write('\tWriting OpenSearch ENTRY elements %.f / %d \r' %(counter,entries.length))
-                sys.stdout.flush()
-                self.write_to_file(entry,fname)
-                counter += 1
-            else:
-                sys.stdout.write('\tNo filename availible. Not able to write OpenSearch entry (%s) to file' % dom)
-
-            # Temporary break when testing
-            #if counter == 5:
-            #    break;
-
-    def ogccsw_writeCSWISOtoFile(self,dom):
-        """ Write CSW-ISO elements in dom to file """
-        myns = {
-                'csw':'http://www.opengis.net/cat/csw/2.0.2',
-                'gmd':'http://www.isotc211.org/2005/gmd',
-                'gco':'http://www.isotc211.org/2005/gco',
-                'gml':'http://www.opengis.net/gml/3.2'
-                }
-
-        record_elements = dom.xpath('/csw:GetRecordsResponse/csw:SearchResults/gmd:MD_Metadata', 
-                namespaces=myns)
-        # This won't work as NumberOfRecordsReturned is not updated for
-        # the last request...
-##       if len(record_elements) != self.numRecsReturned:
-##           print "Mismatch in number of records, bailing out"
-##           sys.exit(2)
-        self.logger.info("\n\tNumber of records found: %d",len(record_elements))
+    def oaipmh_identify(self):
+        """
+        Send an Identify request to the endpoint and return the datestamp
+        granularity supported, None if not available.
+        """
+        if '?' in self.baseURL:
+            identifyURL = self.baseURL+'&verb=Identify'
+        else:
+            identifyURL = self.baseURL+'?verb=Identify'
+        self.logger.info("\n\tURL request: %s", identifyURL)
+        myxml = self.harvestContent(identifyURL)
+        if myxml == None:
+            return None
+        granularity = myxml.find('.//{*}Identify/{*}granularity')
+        if granularity == None:
+            self.logger.warning("No granularity found in Identify response")
+            return None
 
-        numRecs = len(record_elements)
+        return granularity.text
 
+    def oaipmh_nextURL(self, getRecordsURL, resumptionToken, verb='ListRecords'):
+        """
+        Construct the ListRecords (or other verb) request for the page
+        identified by resumptionToken.
+        """
+        baseURL = self.baseURL
+        # create resumptionToken URL parameter
+        #resumptionToken = urlencode({'resumptionToken':resumptionToken})
+        resumptionToken = 'resumptionToken='+resumptionToken
+        # Ideally this should be handled more smooth
+        resumptionTokenSpecialTreatment = ['geonetwork', 'eu-interact', 'nilu']
+        #if 'geonetwork' in baseURL:
+        if '?' in baseURL:
+            '''
+            Handling pycsw OAI-PMH at NILU (else NILU will trigger next) newest end point
+            '''
+            getRecordsURLLoop = str(getRecordsURL+'&'+resumptionToken)
+        elif any(x in baseURL for x in resumptionTokenSpecialTreatment):
+            getRecordsURLLoop = str(baseURL+'?verb='+verb+'&'+resumptionToken)
+        else:
+            getRecordsURLLoop = str(getRecordsURL+'&'+resumptionToken)
+
+        return getRecordsURLLoop
+
+    def writeRecords(self, dom, stats=None):
+        """
+        Write the records of a harvested page (ListRecords or GetRecords)
+        and complete the page. stats holds the metrics of the page, as
+        collected by harvestContent.
+        """
+        write_start = time.perf_counter()
+        record_elements = self.recordFormat.find_records(dom)
+        self.logger.info("\n\tNumber of records found: %d",len(record_elements))
         counter = 0
         for record in record_elements:
-            cswid = record.find('gmd:fileIdentifier/gco:CharacterString',
-                    namespaces=myns)
-            if cswid == None:
-                self.logger.warn("Skipping record, no FileID")
-                continue
-            # Dump to file...
-            self.write_to_file(record, cswid.text)
-            counter += 1
-        self.logger.info("\n\tNumber of records written: %d", counter)
+            counter += self.writeRecord(record)
+        self.logger.info("\n\tNumber of records written to files: %d", counter)
         self.numRecHarv += counter
+        self.endPage()
+        if stats != None:
+            stats.update(records_found=len(record_elements),
+                    records_written=counter,
+                    write_time=round(time.perf_counter()-write_start, 4))
+            self.recordPage(stats)
         return
 
-    def oaipmh_writeISOtoFile(self, dom):
-        """ 
-        Write ISO elements in dom to file 
-        """
-        myns = {
-                'oai':'http://www.openarchives.org/OAI/2.0/',
-                'gmd':'http://www.isotc211.org/2005/gmd',
-                'gmi':'http://www.isotc211.org/2005/gmi',
-                'gco':'http://www.isotc211.org/2005/gco',
-                'gml':'http://www.opengis.net/gml/3.2'
-                }
-        record_elements =  dom.xpath('/oai:OAI-PMH/oai:ListRecords/oai:record', 
-                namespaces=myns)
-        self.logger.info("\n\tNumber of records found: %d",len(record_elements)+1)
-        size_dif = len(record_elements)
+    def writeRecord(self, record, datestamps=None):
+        """
+        Write a single record according to the format harvested. Deleted
+        records are registered and handled by endPage. Returns the number
+        of records written (0 or 1). datestamps (identifier and datestamp)
+        replaces the datestamps of the records in the index, e.g. by
+        those of a listing compared in the next harvest.
+        """
+        myrec = self.recordFormat.extract(record)
+        if datestamps != None and datestamps.get(myrec.identifier):
+            myrec = myrec._replace(datestamp=datestamps[myrec.identifier])
+        if myrec.deleted:
+            self.logger.info("This record has been deleted:\n\t%s",myrec.identifier)
+            self.markDeleted(myrec.identifier, myrec.datestamp)
+            return 0
+        if myrec.payload == None:
+            self.logger.warning("Skipping record, no %s metadata: %s",
+                    self.recordFormat.name, myrec.identifier)
+            return 0
+        if myrec.nativeid == None:
+            self.logger.warning("Skipping record, no %s ID: %s",
+                    self.recordFormat.name, myrec.identifier)
+            return 0
+        # Dump to file
+        filename, checksum, changed = self.write_to_file(myrec.payload,
+                myrec.nativeid)
+        self.indexRecord(myrec.identifier, myrec.datestamp, filename,
+                nativeid=myrec.nativeid, checksum=checksum)
+        if changed:
+            if self.transform != None:
+                self.transformRecord(myrec.payload, filename)
+            with self.lock:
+                self.changed.append(filename)
+        return 1
 
-        counter = 0
-        if size_dif != 0:
-            #counter = 1
-            for record in record_elements:
-                # Check header if deleted
-                datestamp = record.find('oai:header/oai:datestamp',
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'})
-                if datestamp != None:
-                    datestamp = datestamp.text
-                oaiid = record.find('oai:header/oai:identifier',
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'}).text
-                delete_status = record.find("oai:header[@status='deleted']",
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'})
-                # Need to add handling of deleted records,
-                # i.e. modify old records...
-                # Challenges arise when oaiid and isoid are different as
-                # isoid is used as the filename...
-                if delete_status != None:
-                    # TODO: Fix MMD records if record is deleted...
-                    self.logger.info("This record has been deleted:\n\t%s",oaiid)
-                    # Extract identifier. These ID appears like oai:<endpoint>:<id>, need to extract the last part, but keep in mind some data centres use : in identifiers.
-                    mmdid = oaiid.split(':',3)[2]
-                    # Update MMD record, i.e. set Inactive if existing
-                    setInactive(self.mmdDir, mmdid, self.logger)
-                    continue
-                isoid = record.find('oai:metadata/gmi:MI_Metadata/gmd:fileIdentifier/gco:CharacterString',
-                        namespaces=myns)
-                if isoid == None:
-                    isoid = record.find('oai:metadata/gmd:MD_Metadata/gmd:fileIdentifier/gco:CharacterString',
-                            namespaces=myns)
-                if isoid == None:
-                    self.logger.warn("Skipping record, no ISO ID")
-                    continue
-                isoid = isoid.text
-                isorec = record.find('oai:metadata/gmd:MD_Metadata',
-                        namespaces=myns)
-                if isorec == None:
-                    isorec = record.find('oai:metadata/gmi:MI_Metadata',
-                            namespaces=myns)
-                if isorec == None:
-                    continue
+    def transformRecord(self, record, filename):
+        """
+        Transform a record to MMD and write it to the MMD directory, named
+        as the raw file. The MMD metadata_identifier and the settings of
+        the transformation are registered in the index.
+        """
+        myroot = copy.deepcopy(record)
+        # The whitespace following the record in the response is not part
+        # of it (as in the raw file)
+        myroot.tail = None
+        mydoc = ET.ElementTree(myroot)
+        try:
+            newxml = self.transform(mydoc)
+        except ET.XSLTApplyError as e:
+            self.logger.error("Could not transform %s to MMD: %s", filename, e)
+            return
+        name = os.path.basename(filename)
+        self.logger.info('Creating MMD file: %s', self.mmdStore.path(name))
+        self.mmdStore.write(name, ET.tostring(newxml, pretty_print=True))
+        mmdid = get_mmdid(newxml)
+        if mmdid and self.index != None:
+            self.index.set_mmdid(filename, mmdid)
+        if self.settings != None and self.index != None:
+            self.index.set_settings(filename, self.settings)
+        return
+
+    def archiveRecords(self):
+        """
+        Write raw records queued by write_to_file, run in a separate
+        thread when archiving asynchronously. None ends the thread.
+        """
+        while True:
+            myitem = self.archiveQueue.get()
+            if myitem == None:
+                break
+            name, record = myitem
+            try:
+                self.store.write(name, ET.tostring(ET.ElementTree(record),
+                    pretty_print=True, xml_declaration=True,
+                    standalone=None, encoding="UTF-8"))
+            except Exception as e:
+                self.logger.error("Could not create output file: %s (%s)",
+                        self.store.path(name), e)
+        return
 
-                # Dump to file
-                self.write_to_file(isorec, isoid)
-                counter += 1
-            self.logger.info("\n\tNumber of records written to files: %d", counter)
+    def oaipmh_harvestAll(self, getRecordsURL, resumptionToken=None):
+        """
+        Harvest all ListRecords pages using the configured strategy,
+        starting at resumptionToken if provided.
+        """
+        if self.stream:
+            self.oaipmh_harvestStreaming(getRecordsURL, resumptionToken)
+        elif self.pipeline:
+            self.oaipmh_harvestPipelined(getRecordsURL, resumptionToken)
         else:
-            self.logger.info("\n\tRecords did not contain ISO elements")
+            self.oaipmh_harvestPages(getRecordsURL, resumptionToken)
+        return
 
-        self.numRecHarv += counter
+    def oaipmh_harvestPages(self, getRecordsURL, resumptionToken=None):
+        """
+        Harvest all ListRecords pages, parsing each page completely before
+        writing the records.
+        """
+        if resumptionToken == None:
+            getRecordsURLLoop = getRecordsURL
+        else:
+            getRecordsURLLoop = self.oaipmh_nextURL(getRecordsURL, resumptionToken)
+        pageCounter = 0
+        """
+        Manage resumptionToken, i.e. segmentation of results in pages
+        """
+        while getRecordsURLLoop != None:
+            self.logger.info("\n\tURL request: %s",getRecordsURLLoop)
+            mystats = {'request': 'ListRecords'}
+            myxml = self.harvestContent(getRecordsURLLoop, stats=mystats)
+            if myxml == None:
+                self.logger.error("Server is not responding properly, page %d", pageCounter+1)
+                raise IOError("Server to harvest is not responding properly")
+            self.oaipmh_checkError(myxml)
+            self.writeRecords(myxml, mystats)
+            pageCounter += 1
+
+            resumptionToken = myxml.find('.//{*}resumptionToken')
+            if resumptionToken == None or resumptionToken.text == None or resumptionToken.text == '0':
+                self.logger.info("Nothing more to do")
+                getRecordsURLLoop = None
+            else:
+                self.logger.info("Resumption token found: %s",resumptionToken.text)
+                self.saveCheckpoint(resumptionToken=resumptionToken.text)
+                self.logger.info("\n\tHandling resumptionToken number: %d", pageCounter)
+                getRecordsURLLoop = self.oaipmh_nextURL(getRecordsURL, resumptionToken.text)
 
         return
 
-    def oaipmh_writeDIFtoFile(self,dom):
-        """ 
-        Write DIF elements in dom to file 
+    def oaipmh_harvestSelective(self, getRecordsURL):
         """
+        Harvest only new and changed records. Identifiers and datestamps
+        are listed using ListIdentifiers and compared to the index of
+        records already harvested, new or changed records are then
+        retrieved using GetRecord in parallel. Records deleted are set
+        inactive after the listing is completed.
+        """
+        listURL = getRecordsURL.replace('verb=ListRecords', 'verb=ListIdentifiers')
+        known = self.index.datestamps()
+        self.logger.info("\n\tNumber of records in index: %d", len(known))
 
-        myns = {
-                'oai':'http://www.openarchives.org/OAI/2.0/',
-                'dif':'http://gcmd.gsfc.nasa.gov/Aboutus/xml/dif/',
-                'xsi':'http://www.w3.org/2001/XMLSchema-instance'
-                }
-        record_elements =  dom.xpath('/oai:OAI-PMH/oai:ListRecords/oai:record', 
-                namespaces=myns)
-        self.logger.info("\n\tNumber of records found: %d",len(record_elements))
-        size_dif = len(record_elements)
-
-        counter = 0
-        if size_dif != 0:
-            for record in record_elements:
-                # Check header if deleted
-                #print(ET.tostring(record))
-                #sys.exit(0)
-                datestamp = record.find('oai:header/oai:datestamp',
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'})
-                if datestamp != None:
-                    datestamp = datestamp.text
-                oaiid = record.find('oai:header/oai:identifier',
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'}).text
-                delete_status = record.find("oai:header[@status='deleted']",
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'})
-                # Need to add handling of deleted records,
-                # i.e. modify old records...
-                # Challenges arise when oaiid and difid are different as
-                # difid is used as the filename...
-                # A rewrite to handle DIF10 nested ENTRY_ID element is needed.
-                if delete_status != None:
-                    # TODO: Fix MMD records if record is deleted...
-                    self.logger.info("This record has been deleted:\n\t%s",oaiid)
-                    # Extract identifier. These ID appears like oai:<endpoint>:<id>, need to extract the last part, but keep in mind some data centres use : in identifiers.
-                    mmdid = oaiid.split(':',3)[2]
-                    # Update MMD record, i.e. set Inactive if existing
-                    setInactive(self.mmdDir, mmdid, self.logger)
-                try:
-                    dif = record.find('oai:metadata/dif:DIF', namespaces=myns)
-                    difschema = dif.xpath("@xsi:schemaLocation", namespaces=myns)
-                except:
-                    self.logger.error("Couldn't find DIF schema, skipping record.")
-                    continue
-                """
-                Decide on handling depending on DIF 10 or previous type of record
-                """
-                if len(difschema) > 0 and "dif_v10" in difschema[0]:
-                    difid = record.find('oai:metadata/dif:DIF/dif:Entry_ID/dif:Short_Name', namespaces=myns)
+        # List identifiers
+        changed = []
+        unchanged = []
+        deleted = []
+        listed = 0
+        listURLLoop = listURL
+        while listURLLoop != None:
+            self.logger.info("\n\tURL request: %s",listURLLoop)
+            mystats = {'request': 'ListIdentifiers'}
+            myxml = self.harvestContent(listURLLoop, stats=mystats)
+            if myxml == None:
+                raise IOError("Server to harvest is not responding properly")
+            self.oaipmh_checkError(myxml)
+            pagelisted = listed
+            for header in myxml.iter('{http://www.openarchives.org/OAI/2.0/}header'):
+                oaiid = header.findtext('{http://www.openarchives.org/OAI/2.0/}identifier')
+                datestamp = header.findtext('{http://www.openarchives.org/OAI/2.0/}datestamp')
+                listed += 1
+                if header.get('status') == 'deleted':
+                    deleted.append((oaiid, datestamp))
+                elif known.get(oaiid) != datestamp:
+                    changed.append(oaiid)
                 else:
-                    difid = record.find('oai:metadata/dif:DIF/dif:Entry_ID', namespaces=myns)
-                if difid == None:
-                    self.logger.warn("Skipping record, no DIF ID")
-                    continue
-                difid = difid.text
-                difrec = record.find('oai:metadata/dif:DIF',
-                        namespaces=myns)
-
-                # Dump to file
-                counter += 1
-                print('>>>> Processing file #: ', counter)
-                self.write_to_file(difrec, difid)
+                    unchanged.append(oaiid)
+            mystats.update(records_found=listed-pagelisted, records_written=0)
+            self.recordPage(mystats)
+            resumptionToken = myxml.find('.//{*}resumptionToken')
+            if resumptionToken == None or resumptionToken.text == None or resumptionToken.text == '0':
+                listURLLoop = None
+            else:
+                listURLLoop = self.oaipmh_nextURL(listURL, resumptionToken.text,
+                        verb='ListIdentifiers')
+        self.logger.info("\n\tIdentifiers listed: %d, new or changed: %d, deleted: %d",
+                listed, len(changed), len(deleted))
+        # Records not changed are still available
+        self.index.touch(unchanged, self.harvestTime)
+
+        # Retrieve new and changed records
+        if '?' in self.baseURL:
+            getRecordURL = self.baseURL+'&verb=GetRecord&metadataPrefix='+self.srcfmt
         else:
-            self.logger.info("\n\tRecords did not contain DIF elements")
+            getRecordURL = self.baseURL+'?verb=GetRecord&metadataPrefix='+self.srcfmt
 
-        self.logger.info("\n\tNumber of records written to files: %d", counter)
+        def fetch(oaiid):
+            mystats = {'request': 'GetRecord'}
+            myxml = self.harvestContent(getRecordURL+'&identifier='+quote(oaiid, safe=''),
+                    stats=mystats)
+            if myxml == None:
+                self.logger.error("Could not retrieve record: %s", oaiid)
+                return 0
+            self.oaipmh_checkError(myxml)
+            record = myxml.find('{*}GetRecord/{*}record')
+            if record == None:
+                self.logger.error("No record returned for: %s", oaiid)
+                return 0
+            write_start = time.perf_counter()
+            counter = self.writeRecord(record)
+            mystats.update(records_found=1, records_written=counter,
+                    write_time=round(time.perf_counter()-write_start, 4))
+            self.recordPage(mystats)
+            return counter
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as pool:
+            counter = sum(pool.map(fetch, changed))
         self.numRecHarv += counter
+        self.endPage()
+        self.logger.info("\n\tNumber of records written to files: %d", counter)
+
+        # Handle deleted records in one batch
+        for oaiid, datestamp in deleted:
+            if oaiid not in known:
+                continue
+            self.logger.info("This record has been deleted:\n\t%s",oaiid)
+            self.markDeleted(oaiid, datestamp)
+        self.endPage()
+
         return
 
-    def oaipmh_writeDCATtoFile(self,dom):
-        """ 
-        Write DCAT elements in dom to file 
-        """
-        self.logger.warning('Not implemented yet')
-        myns = {
-                'oai':'http://www.openarchives.org/OAI/2.0/',
-                'dcat':'http://www.w3.org/ns/dcat#',
-                'rdf':'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
-                }
-        record_elements =  dom.xpath('/oai:OAI-PMH/oai:ListRecords/oai:record', 
-                namespaces=myns)
-        self.logger.info("\n\tNumber of records found: %d",len(record_elements))
-        size_rdf = len(record_elements)
+    def indexRecord(self, identifier, datestamp, filename=None,
+            deleted=False, nativeid=None, checksum=None):
+        """
+        Register a record written (or deleted) in the index. Records
+        written are marked as seen in this harvest.
+        """
+        if self.index != None:
+            if deleted:
+                last_seen = None
+            else:
+                last_seen = self.harvestTime
+            self.index.update(identifier, datestamp, filename, deleted,
+                    nativeid, checksum, last_seen)
+        return
 
-        counter = 0
-        if size_rdf != 0:
-            for record in record_elements:
-                # Check header if deleted
-                # TODO: Check if used with DCAT
-                datestamp = record.find('oai:header/oai:datestamp',
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'})
-                if datestamp != None:
-                    datestamp = datestamp.text
-                oaiid = record.find('oai:header/oai:identifier',
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'}).text
-                delete_status = record.find("oai:header[@status='deleted']",
-                        namespaces={'oai':'http://www.openarchives.org/OAI/2.0/'})
-                if delete_status != None:
-                    self.logger.info("This record has been deleted:\n\t%s",oaiid)
-                    # Extract identifier. These ID appears like oai:<endpoint>:<id>, need to extract the last part, but keep in mind some data centres use : in identifiers.
-                    mmdid = oaiid.split(':',3)[2]
-                    # Update MMD record, i.e. set Inactive if existing
+    def markDeleted(self, identifier, datestamp):
+        """
+        Register a record deleted at the source, the MMD record is set
+        inactive by endPage.
+        """
+        self.deleted.append((identifier, datestamp))
+        return
+
+    def endPage(self):
+        """
+        Complete the handling of a page. MMD records of records deleted
+        are set inactive in one batch and the index and stores are
+        committed.
+        """
+        with self.lock:
+            mydeleted, self.deleted = self.deleted, []
+        for identifier, datestamp in mydeleted:
+            myrec = None
+            if self.index != None:
+                myrec = self.index.lookup(identifier)
+            if myrec != None and myrec['deleted']:
+                # Already handled
+                continue
+            if myrec != None and myrec['filename']:
+                setInactiveRecord(self.mmdStore,
+                        os.path.basename(myrec['filename']), self.logger)
+            else:
+                # Not in the index, guess the file name from the
+                # identifier. These ID appears like oai:<endpoint>:<id>,
+                # need to extract the last part, but keep in mind some
+                # data centres use : in identifiers.
+                mmdid = identifier.split(':',2)[-1]
+                mmdname = sanitise_id(mmdid)+'.xml'
+                if self.mmdStore.exists(mmdname):
+                    setInactiveRecord(self.mmdStore, mmdname, self.logger)
+                else:
                     setInactive(self.mmdDir, mmdid, self.logger)
-                # Not sure how identifiers are handled in the stream we have access to so far.
-                #dcatid = record.find('oai:metadata/dif:DIF/dif:Entry_ID', namespaces=myns)
-                dcatid = oaiid
-                if dcatid == None:
-                    self.logger.warn("Skipping record, no DIF ID")
+            self.indexRecord(identifier, datestamp, deleted=True)
+        if self.index != None:
+            self.index.commit()
+        if self.store != None:
+            self.store.commit()
+            self.mmdStore.commit()
+        return
+
+    def oaipmh_checkError(self, myxml):
+        """
+        Check a response for OAI-PMH errors. Raises ResumptionTokenError if
+        the resumptionToken was rejected, other errors are logged.
+        """
+        for error in myxml.iter('{http://www.openarchives.org/OAI/2.0/}error'):
+            if error.get('code') == 'badResumptionToken':
+                raise ResumptionTokenError(error.text)
+            elif error.get('code') == 'noRecordsMatch':
+                self.logger.info("No records matching the request")
+            else:
+                self.logger.error("OAI-PMH error (%s): %s", error.get('code'), error.text)
+        return
+
+    def saveCheckpoint(self, **kwargs):
+        """
+        Report the position of the next page once the current page is
+        written, e.g. resumptionToken, startposition or start.
+        """
+        if self.checkpoint != None:
+            self.checkpoint(kwargs)
+        return
+
+    def recordPage(self, stats):
+        """
+        Report the metrics of a page harvested.
+        """
+        if self.metrics != None:
+            self.metrics.page(stats)
+        return
+
+    def oaipmh_harvestPipelined(self, getRecordsURL, resumptionToken=None):
+        """
+        Harvest all ListRecords pages with download and writing
+        overlapping. A fetcher thread requests the next page as soon as
+        the resumptionToken of the current page is known, while the
+        records of the current page are written by a pool of writers. The
+        page queue is bounded (prefetch) to keep memory under control.
+        """
+        pages = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # Block while the queue is full, but give up if the consumer stopped
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
                     continue
-                dcatrec = record.find('oai:metadata/rdf:RDF', namespaces=myns)
-                # TODO: Collect the linked information...
-                #print(ET.tostring(dcatrec, pretty_print=True))
+            return False
 
-                # Dump to file
-                counter += 1
-                self.write_to_file(dcatrec, dcatid)
+        def fetcher():
+            pageCounter = 0
+            if resumptionToken == None:
+                getRecordsURLLoop = getRecordsURL
+            else:
+                getRecordsURLLoop = self.oaipmh_nextURL(getRecordsURL, resumptionToken)
+            try:
+                while getRecordsURLLoop != None and not stop.is_set():
+                    self.logger.info("\n\tURL request: %s",getRecordsURLLoop)
+                    fetch_start = time.perf_counter()
+                    mystats = {'request': 'ListRecords'}
+                    myxml = self.harvestContent(getRecordsURLLoop, stats=mystats)
+                    fetch_time = time.perf_counter()-fetch_start
+                    if myxml == None:
+                        raise IOError("Server to harvest is not responding properly")
+                    self.oaipmh_checkError(myxml)
+                    pageCounter += 1
+                    nextToken = myxml.find('.//{*}resumptionToken')
+                    if nextToken == None or nextToken.text == None or nextToken.text == '0':
+                        self.logger.info("Nothing more to do")
+                        nextToken = None
+                        getRecordsURLLoop = None
+                    else:
+                        nextToken = nextToken.text
+                        self.logger.info("Resumption token found: %s",nextToken)
+                        getRecordsURLLoop = self.oaipmh_nextURL(getRecordsURL, nextToken)
+                    if not put((pageCounter, myxml, nextToken, fetch_time, mystats)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        mythread = threading.Thread(target=fetcher, name='oaipmh-fetcher', daemon=True)
+        fetch_total = write_total = wait_total = 0.
+        mythread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.writers) as pool:
+                while True:
+                    wait_start = time.perf_counter()
+                    item = pages.get()
+                    wait_time = time.perf_counter()-wait_start
+                    if item == None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    pageCounter, myxml, nextToken, fetch_time, mystats = item
+                    write_start = time.perf_counter()
+                    record_elements = self.recordFormat.find_records(myxml)
+                    counter = sum(pool.map(self.writeRecord, record_elements))
+                    write_time = time.perf_counter()-write_start
+                    self.numRecHarv += counter
+                    self.endPage()
+                    if nextToken != None:
+                        self.saveCheckpoint(resumptionToken=nextToken)
+                    fetch_total += fetch_time
+                    write_total += write_time
+                    wait_total += wait_time
+                    self.logger.info("\n\tPage %d: %d records found, %d written, fetch %.2fs, waited %.2fs, write %.2fs",
+                            pageCounter, len(record_elements), counter,
+                            fetch_time, wait_time, write_time)
+                    mystats.update(records_found=len(record_elements),
+                            records_written=counter,
+                            write_time=round(write_time, 4),
+                            wait_time=round(wait_time, 4))
+                    self.recordPage(mystats)
+        finally:
+            stop.set()
+        self.logger.info("\n\tPipeline totals: fetch %.2fs, waiting for pages %.2fs, write %.2fs",
+                fetch_total, wait_total, write_total)
+
+        return
+
+    def oaipmh_harvestStreaming(self, getRecordsURL, resumptionToken=None):
+        """
+        Harvest all ListRecords pages using the streaming parser, i.e.
+        records are written while each page is downloaded.
+        """
+        pageCounter = 0
+        if resumptionToken == None:
+            getRecordsURLLoop = getRecordsURL
         else:
-            self.logger.info("\n\tRecords did not contain DIF elements")
+            getRecordsURLLoop = self.oaipmh_nextURL(getRecordsURL, resumptionToken)
+        while getRecordsURLLoop != None:
+            self.logger.info("\n\tURL request: %s",getRecordsURLLoop)
+            resumptionToken = self.oaipmh_streamRecords(getRecordsURLLoop)
+            pageCounter += 1
+            if resumptionToken == None or resumptionToken == '0':
+                self.logger.info("Nothing more to do")
+                getRecordsURLLoop = None
+            else:
+                self.logger.info("Resumption token found: %s",resumptionToken)
+                self.saveCheckpoint(resumptionToken=resumptionToken)
+                self.logger.info("\n\tHandling resumptionToken number: %d", pageCounter)
+                getRecordsURLLoop = self.oaipmh_nextURL(getRecordsURL, resumptionToken)
+        return
 
+    def oaipmh_streamRecords(self, URL):
+        """
+        Parse a ListRecords page incrementally while it is downloaded.
+        Each record is written as soon as it is complete and freed
+        afterwards, keeping memory usage independent of the page size.
+        Returns the resumptionToken of the page, None if not found.
+        """
+        oains = '{http://www.openarchives.org/OAI/2.0/}'
+        mytags = (oains+'record', oains+'resumptionToken', oains+'error')
+        resumptionToken = None
+        found = 0
+        counter = 0
+        write_time = 0.
+        try:
+            fetch_start = time.perf_counter()
+            with self.client.get(URL, stream=True) as response:
+                ttfb = time.perf_counter()-fetch_start
+                response.raise_for_status()
+                myencoding = self.getEncoding(response.headers.get('Content-Type'))
+                response.raw.decode_content = True
+                mycontext = ET.iterparse(response.raw, events=('end',),
+                        tag=mytags, encoding=myencoding)
+                for event, elem in mycontext:
+                    if elem.tag == oains+'record':
+                        found += 1
+                        write_start = time.perf_counter()
+                        counter += self.writeRecord(elem)
+                        write_time += time.perf_counter()-write_start
+                    elif elem.tag == oains+'resumptionToken':
+                        resumptionToken = elem.text
+                    elif elem.get('code') == 'badResumptionToken':
+                        raise ResumptionTokenError(elem.text)
+                    elif elem.get('code') == 'noRecordsMatch':
+                        self.logger.info("No records matching the request")
+                    else:
+                        self.logger.error("OAI-PMH error (%s): %s",
+                                elem.get('code'), elem.text)
+                    # Free the element and the siblings already processed
+                    elem.clear(keep_tail=True)
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+                del mycontext
+            latency = time.perf_counter()-fetch_start
+            with self.lock:
+                self.numBytes += response.raw.tell()
+        except ResumptionTokenError:
+            raise
+        except Exception as e:
+            self.logger.error("Streaming harvest failed for: \n\t %s\n\t%s", URL, e)
+            raise IOError("Server to harvest is not responding properly")
+        self.logger.info("\n\tNumber of records found: %d", found)
         self.logger.info("\n\tNumber of records written to files: %d", counter)
         self.numRecHarv += counter
-        return
+        self.endPage()
+        # Download, decompression and parsing overlap, parse_time covers
+        # all of these
+        self.recordPage({'request': 'ListRecords', 'url': URL,
+            'latency': round(latency, 4), 'ttfb': round(ttfb, 4),
+            'bytes': response.raw.tell(),
+            'parse_time': round(latency-ttfb-write_time, 4),
+            'records_found': found, 'records_written': counter,
+            'write_time': round(write_time, 4)})
+
+        return resumptionToken
+
+    def ogccsw_listRecords(self, getRecordsURL, elementSet='brief'):
+        """
+        List all records using the brief (or summary) element set, i.e.
+        Dublin Core records holding little more than the identifier.
+        Returns a dictionary of identifier and modification date (if
+        provided), None if the listing is incomplete.
+        """
+        listURL = update_query(getRecordsURL, {
+            'typeNames': 'csw:Record',
+            'outputSchema': CSW_NAMESPACE,
+            'elementSetName': elementSet})
+        myformat = FORMATS['csw-brief']
+        listed = {}
+        # Records listed without identifier, still counted as listed
+        unidentified = 0
+        numRecsFound = 0
+        nextRec = 1
+        while nextRec > 0:
+            mystats = {'request': 'GetRecords'}
+            dom = self.harvestContent(listURL+'&startposition='+str(nextRec),
+                    stats=mystats)
+            if dom == None:
+                self.logger.error("Listing of records failed at startposition %d", nextRec)
+                return None
+            cswHeader = dom.find('csw:SearchResults',
+                    namespaces={'csw':CSW_NAMESPACE})
+            if cswHeader == None:
+                self.logger.error("Could not parse header response when listing records")
+                return None
+            records = myformat.find_records(dom)
+            for record in records:
+                myrec = myformat.extract(record)
+                if myrec.nativeid != None:
+                    listed[myrec.nativeid] = myrec.datestamp
+                else:
+                    unidentified += 1
+            mystats.update(records_found=len(records), records_written=0)
+            self.recordPage(mystats)
+            numRecsFound = int(cswHeader.get('numberOfRecordsMatched') or 0)
+            nextRec = int(cswHeader.get('nextRecord') or 0)
+            if nextRec > numRecsFound:
+                nextRec = 0
+        self.logger.info("\n\tNumber of records listed: %d", len(listed))
+        # Servers may stop paging early, records not listed would then be
+        # taken as removed
+        if len(listed)+unidentified < numRecsFound:
+            self.logger.error("Listing of records is incomplete, %d of %d records listed",
+                    len(listed)+unidentified, numRecsFound)
+            return None
+
+        return listed
+
+    def ogccsw_harvestSelective(self, getRecordsURL):
+        """
+        Harvest only new and changed records. Identifiers and modification
+        dates are listed using the summary element set and compared to the
+        index of records already harvested, new or changed records are then
+        retrieved using GetRecordById in batches, in parallel. Records no
+        longer listed are set inactive. Returns False if the listing
+        failed.
+        """
+        listed = self.ogccsw_listRecords(getRecordsURL, 'summary')
+        if not listed:
+            return False
+        known = self.index.datestamps()
+        self.logger.info("\n\tNumber of records in index: %d", len(known))
+        # Records without modification date are always retrieved
+        changed = [x for x in listed if listed[x] == None or known.get(x) != listed[x]]
+        removed = [x for x in known if x not in listed]
+        self.logger.info("\n\tRecords listed: %d, new or changed: %d, removed: %d",
+                len(listed), len(changed), len(removed))
+        # Records not changed are still available
+        self.index.touch([x for x in known if x in listed], self.harvestTime)
+
+        # Retrieve new and changed records
+        getRecordURL = recordbyid_url(getRecordsURL)
+        batches = [changed[i:i+self.batchsize]
+                for i in range(0, len(changed), self.batchsize)]
+
+        def fetch(batch):
+            mystats = {'request': 'GetRecordById'}
+            myxml = self.harvestContent(getRecordURL+'&id='+quote(','.join(batch), safe=','),
+                    stats=mystats)
+            if myxml == None:
+                self.logger.error("Could not retrieve %d records, first: %s",
+                        len(batch), batch[0])
+                return 0
+            write_start = time.perf_counter()
+            records = self.recordFormat.find_records(myxml)
+            if len(records) < len(batch):
+                self.logger.warning("Only %d of %d records returned", len(records), len(batch))
+            counter = 0
+            for record in records:
+                counter += self.writeRecord(record, listed)
+            mystats.update(records_found=len(records), records_written=counter,
+                    write_time=round(time.perf_counter()-write_start, 4))
+            self.recordPage(mystats)
+            return counter
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as pool:
+            counter = sum(pool.map(fetch, batches))
+        self.numRecHarv += counter
+        self.endPage()
+        self.logger.info("\n\tNumber of records written to files: %d", counter)
+
+        # Handle removed records in one batch
+        for identifier in removed:
+            self.logger.info("This record has been removed:\n\t%s",identifier)
+            self.markDeleted(identifier, known[identifier])
+        self.endPage()
+
+        return True
+
+    def ogccsw_checkRemoved(self, getRecordsURL):
+        """
+        Find records removed at the source by listing all identifiers.
+        Records still available are marked as seen, records no longer
+        listed are set inactive. Returns False if the listing failed.
+        """
+        listed = self.ogccsw_listRecords(getRecordsURL)
+        if not listed:
+            self.logger.warning("No records listed, not checking for removed records")
+            return False
+        known = self.index.datestamps()
+        self.index.touch([x for x in known if x in listed], self.harvestTime)
+        for identifier in known:
+            if identifier not in listed:
+                self.logger.info("This record has been removed:\n\t%s",identifier)
+                self.markDeleted(identifier, known[identifier])
+        self.endPage()
+
+        return True
+
+    def ogccsw_harvestParallel(self, getRecordsURL, nextRec, numRecsFound):
+        """
+        Harvest the remaining GetRecords pages concurrently. All
+        startposition values are known from the first response. Returns
+        False if pages could not be harvested.
+        """
+        pageSize = self.numRecsReturned
+        if pageSize < 1:
+            self.logger.error("No records returned in first page, can't compute page offsets")
+            return False
+        positions = list(range(nextRec, numRecsFound+1, pageSize))
+        def pageURL(position):
+            return getRecordsURL+'&startposition='+str(position)
+
+        return self.harvestParallel(positions, pageURL, 'GetRecords', 'startposition')
+
+    def harvestParallel(self, positions, pageURL, request, key,
+            credentials=False):
+        """
+        Harvest pages at known positions (e.g. CSW startposition or
+        OpenSearch start) concurrently. Pages are fetched by at most
+        self.concurrency workers and written as they arrive. pageURL
+        returns the URL of a position, the first position not written is
+        saved as checkpoint using key. Returns False if pages could not be
+        harvested, the checkpoint is then kept at the first page missing.
+        """
+        self.logger.info("\n\tFetching %d pages using %d workers", len(positions), self.concurrency)
+
+        def fetch(position):
+            mystats = {'request': request}
+            return self.harvestContent(pageURL(position),
+                    credentials=credentials, uname=self.username,
+                    pw=self.pw, stats=mystats), mystats
+
+        failed = []
+        # Pages not written yet, the first of these is the checkpoint
+        remaining = set(positions)
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as pool:
+            futures = {pool.submit(fetch, position): position for position in positions}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    dom, mystats = future.result()
+                except Exception as e:
+                    self.logger.error("Page at %s %d failed: %s", key, position, e)
+                    dom = None
+                if dom == None:
+                    failed.append(position)
+                    continue
+                # Writing is done here to keep numRecHarv consistent
+                self.writeRecords(dom, mystats)
+                remaining.discard(position)
+                if remaining and not failed:
+                    self.saveCheckpoint(**{key: min(remaining)})
+        if failed:
+            self.logger.error("\n\t%d pages could not be harvested, %s: %s",
+                    len(failed), key, ', '.join(str(x) for x in sorted(failed)))
+            return False
+
+        return True
 
     def write_to_file(self, record, myid):
         """ Function for storing harvested metadata to file
             - root: root Element to be stored. <DOM Element>
             - fname: unique id. <String>
             - output_path: output directory. <String>
+            Returns filename, checksum of the canonical XML and whether
+            the file was written. Files are not rewritten if the checksum
+            is unchanged since last harvest (and transformed with the
+            same settings).
         """
         if not os.path.isdir(self.outputDir):
            try:
-               os.makedirs(self.outputDir)
+               os.makedirs(self.outputDir, exist_ok=True)
            except:
                self.logger.error("Could not create output directory: %s", self.outputDir)
                sys.exit(2)
 
-        myid = myid.replace('/','-')
-        myid = myid.replace(':','-')
-        myid = myid.replace('.','-')
-        filename = self.outputDir+'/'+myid+'.xml'
+        name = sanitise_id(myid)+'.xml'
+        mystore = get_store(self.outputDir, self.layout)
+        filename = mystore.path(name)
+        checksum = hashlib.sha256(ET.tostring(record, method='c14n',
+            exclusive=True)).hexdigest()
+        # Records are rewritten if any of the files written is missing
+        exists = (not self.archive or mystore.exists(name)) and \
+                (self.transform == None or self.mmdStore.exists(name))
+        mysettings = None
+        if self.transform != None:
+            mysettings = self.settings
+        if self.index != None and exists and \
+                self.index.checksum(filename, mysettings) == checksum:
+            self.logger.debug('Unchanged file: %s', filename)
+            return filename, checksum, False
+        if not self.archive:
+            return filename, checksum, True
+        elif self.archive == 'async':
+            # The record may be cleared when written, e.g. when streaming
+            self.archiveQueue.put((name, copy.deepcopy(record)))
+            return filename, checksum, True
         outputstr = ET.ElementTree(record)
         try:
             self.logger.info('Creating file: %s', filename)
-            outputstr.write(filename, pretty_print=True,
-                    xml_declaration=True, standalone=None, 
-                    encoding="UTF-8")
+            mystore.write(name, ET.tostring(outputstr, pretty_print=True,
+                    xml_declaration=True, standalone=None,
+                    encoding="UTF-8"))
         except:
             self.logger.error("Could not create output file: %s", filename)
             raise Exception("Could not create output file.")
             sys.exit(2)
-        return
+        return filename, checksum, True
 
-    def harvestContent(self,URL,credentials=False,uname="foo",pw="bar"):
-        ssl._create_default_https_context = ssl._create_unverified_context        
-        """ Function for harvesting content from URL."""
+    def getEncoding(self, contenttype):
+        """ Decide on encoding from the Content-Type header """
+        # This is a bit awkward, but in order to improve robustness, multiple checks are required. Could be simplified, but not necessarily more readable.
+        if contenttype is None:
+            self.logger.warn('No Content-Type received from the server.')
+            myencoding = 'UTF-8'
+        elif 'charset' in contenttype:
+            myencoding = contenttype.split('=',1)[1] 
+        elif 'application/xml' in contenttype:
+            self.logger.warn('No charset provided, assuming UTF-8')
+            myencoding = 'UTF-8'
+        else:
+            self.logger.warn('No Content-Type received from the server. Not sure why we ended up here. Assuming UTF-8')
+            self.logger.warn('Header received: %s', contenttype)
+            myencoding = 'UTF-8'
+        return myencoding
+
+    def harvestContent(self,URL,credentials=False,uname=None,pw=None,stats=None):
+        """
+        Function for harvesting content from URL. If credentials is set and
+        uname provided, basic authentication is used. If stats
+        (dictionary) is provided, the time spent on each stage and the
+        bytes received are added to it.
+        """
+        if credentials and uname != None:
+            myauth = (uname, pw)
+        else:
+            myauth = None
+        # Timeout depends on user, 60 seconds is too little for
+        # NSIDC and NPOLAR, default is 5 minutes
         try:
-            if not credentials:
-                # Timeout depends on user, 60 seconds is too little for
-                # NSIDC and NPOLAR, increasing to 5 minutes
-                ##myreq = ul.Request(URL)
-                try:
-                    with ul.urlopen(URL,timeout=300) as response:
-                        ##print('>>>>', response.getheader('Content-Type'))
-                        # This is a bit awkward, but in order to improve robustness, multiple checks are required. Could be simplified, but not necessarily more readable.
-                        if response.getheader('Content-Type') is None:
-                            self.logger.warn('No Content-Type received from the server.')
-                            myencoding = 'UTF-8'
-                        elif 'charset' in response.getheader('Content-Type'):
-                            myencoding = response.getheader('Content-Type').split('=',1)[1] 
-                        elif 'application/xml' in response.getheader('Content-Type'):
-                            self.logger.warn('No charset provided, assuming UTF-8')
-                            myencoding = 'UTF-8'
-                        else:
-                            self.logger.warn('No Content-Type received from the server. Not sure why we ended up here. Assuming UTF-8')
-                            self.logger.warn('Header received: %s', response.getheader('Content-Type'))
-                            myencoding = 'UTF-8'
-                        #myfile = bytes(response.read())
-                        myfile = response.read()
-                    myparser = ET.XMLParser(ns_clean=True,
-                            encoding=myencoding)
-                    try:
-                        data = ET.fromstring(myfile,myparser)
-                    except Exception as e:
-                        self.logger.error('Parsing the harvested information failed due to: %s', e)
-                    return data
-                except Exception as e:
-                    self.logger.error('Couldn not retrieve data: %s', e)
-            else:
-                # Not working with lxml
-                self.logger.warn("Authenticated and authorised use is not implemented yet...")
-                return
-#                p = ul.HTTPPasswordMgrWithDefaultRealm()
-#                p.add_password(None, URL, uname, pw)
-#                handler = ul.HTTPBasicAuthHandler(p)
-#                opener = ul.build_opener(handler)
-#                ul.install_opener(opener)
-#                return parseString(ul.urlopen(URL).read())
+            # The raw content is read to time transfer and
+            # decompression separately
+            fetch_start = time.perf_counter()
+            with self.client.get(URL, stream=True, auth=myauth) as response:
+                ttfb = time.perf_counter()-fetch_start
+                response.raise_for_status()
+                myencoding = self.getEncoding(response.headers.get('Content-Type'))
+                mycontent = response.raw.read(decode_content=False)
+                mycoding = response.headers.get('Content-Encoding')
+            latency = time.perf_counter()-fetch_start
+            with self.lock:
+                self.numBytes += len(mycontent)
+            decompress_start = time.perf_counter()
+            myfile = decode_content(mycontent, mycoding)
+            decompress_time = time.perf_counter()-decompress_start
         except Exception as e:
             self.logger.error("There was an error with the URL request. Could not open or parse content from: \n\t %s\n\t%s", URL, e)
-
-    def oaipmh_resumptionToken(self,URL):
-        # Not used currently, to be removed?
-        """ Function for handling resumptionToken in OAI-PMH"""
-        #print("Now in resumptionToken...", URL)
+            return None
+        if stats != None:
+            stats.update(url=URL, latency=round(latency, 4),
+                    ttfb=round(ttfb, 4), bytes=len(mycontent),
+                    decompress_time=round(decompress_time, 4))
+        myparser = ET.XMLParser(ns_clean=True,
+                encoding=myencoding)
+        parse_start = time.perf_counter()
+        data = None
         try:
-            file = ul.request.urlopen(URL, timeout=300)
-            data = file.read()
-            file.close()
-            dom = parseString(data)
-
-            if dom.getElementsByTagName('resumptionToken').length == 0:
-                return dom.getElementsByTagName('resumptionToken')
-            else:
-                if dom.getElementsByTagName('resumptionToken')[0].firstChild != None:
-                    return dom.getElementsByTagName('resumptionToken')[0].firstChild.nodeValue
-                else:
-                    return []
-        except ul.error.URLError as e:
-            self.logger.error("There was an error with the URL request: %s", e)
+            data = ET.fromstring(myfile,myparser)
+        except Exception as e:
+            self.logger.error('Parsing the harvested information failed due to: %s', e)
+        if stats != None:
+            stats['parse_time'] = round(time.perf_counter()-parse_start, 4)
+        return data
@@ -0,0 +1,155 @@
+"""
+PURPOSE:
+    Performance metrics of harvests. Each page harvested is reported with
+    the time spent in each stage, and each source with totals when the
+    harvest is completed. Metrics are written as JSON lines (one object
+    per page and per source) and/or as a Prometheus textfile (for the
+    node_exporter textfile collector) summarising the sources of the run.
+
+NOTES:
+    - Page metrics (type page), times in seconds:
+        - latency: request sent until the response is received
+        - ttfb: request sent until the headers are received
+        - bytes: bytes received (compressed if transfer is compressed)
+        - decompress_time, parse_time, write_time
+        - records_found, records_written
+      Not all stages are available for all requests, e.g. decompression
+      and parsing are interleaved when streaming.
+    - Source metrics (type source) hold the sum of the page metrics,
+      records harvested, wall time, records per second and status.
+    - The Prometheus textfile is replaced when the run is completed, only
+      sources harvested in the run are included.
+
+"""
+
+import os
+import json
+import threading
+from datetime import datetime, timezone
+
+# Page metrics summed per source
+TOTALS = ['latency', 'ttfb', 'bytes', 'decompress_time', 'parse_time',
+        'write_time', 'records_found', 'records_written']
+
+class MetricsWriter(object):
+    """
+    Collects the metrics of all sources harvested in a run. Access is
+    serialised, sources harvested concurrently can share an instance.
+    """
+    def __init__(self, jsonfile=None, promfile=None):
+        self.jsonfile = jsonfile
+        self.promfile = promfile
+        self.lock = threading.Lock()
+        self.sources = []
+        self.myfile = None
+        if jsonfile != None:
+            self.myfile = open(jsonfile, 'a')
+
+    def source(self, section, protocol=None):
+        """ Create the metrics of a source """
+        mysource = SourceMetrics(self, section, protocol)
+        with self.lock:
+            self.sources.append(mysource)
+        return mysource
+
+    def emit(self, entry):
+        """ Write an entry as a JSON line """
+        if self.myfile == None:
+            return
+        myline = json.dumps(entry, sort_keys=True)
+        with self.lock:
+            self.myfile.write(myline+'\n')
+            self.myfile.flush()
+
+    def close(self):
+        """ Write the Prometheus textfile and close the JSON lines file """
+        if self.promfile != None:
+            self.write_textfile()
+        if self.myfile != None:
+            self.myfile.close()
+            self.myfile = None
+
+    def write_textfile(self):
+        """ Write source totals in the Prometheus text format """
+        metrics = [
+                ('mdharvest_records', 'gauge', 'Records harvested', 'records'),
+                ('mdharvest_pages', 'gauge', 'Pages harvested', 'pages'),
+                ('mdharvest_bytes', 'gauge', 'Bytes received', 'bytes'),
+                ('mdharvest_walltime_seconds', 'gauge', 'Wall time of the harvest', 'walltime'),
+                ('mdharvest_records_per_second', 'gauge', 'Records harvested per second', 'records_per_second'),
+                ('mdharvest_success', 'gauge', 'Whether the harvest succeeded', 'success'),
+                ('mdharvest_last_run_timestamp_seconds', 'gauge', 'End of the harvest', 'timestamp'),
+                ]
+        stages = ['latency', 'ttfb', 'decompress_time', 'parse_time', 'write_time']
+        lines = []
+        with self.lock:
+            mysources = [x for x in self.sources if x.summary != None]
+        for name, mytype, myhelp, key in metrics:
+            lines.append('# HELP %s %s' % (name, myhelp))
+            lines.append('# TYPE %s %s' % (name, mytype))
+            for mysource in mysources:
+                lines.append('%s{source="%s"} %s' % (name,
+                    prom_label(mysource.section), mysource.summary[key]))
+        name = 'mdharvest_stage_seconds'
+        lines.append('# HELP %s Time spent per stage, summed over pages' % name)
+        lines.append('# TYPE %s gauge' % name)
+        for mysource in mysources:
+            for stage in stages:
+                lines.append('%s{source="%s",stage="%s"} %s' % (name,
+                    prom_label(mysource.section), stage.replace('_time', ''),
+                    mysource.summary[stage]))
+        tmpfile = self.promfile+'.tmp'
+        with open(tmpfile, 'w') as myfile:
+            myfile.write('\n'.join(lines)+'\n')
+        os.replace(tmpfile, self.promfile)
+
+class SourceMetrics(object):
+    """
+    Metrics of the harvest of a single source.
+    """
+    def __init__(self, writer, section, protocol=None):
+        self.writer = writer
+        self.section = section
+        self.protocol = protocol
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.totals = dict.fromkeys(TOTALS, 0)
+        self.summary = None
+
+    def page(self, stats):
+        """ Report the metrics of a page """
+        with self.lock:
+            self.pages += 1
+            for key in TOTALS:
+                if stats.get(key) != None:
+                    self.totals[key] += stats[key]
+        myentry = {'type': 'page', 'source': self.section, 'time': now()}
+        myentry.update(stats)
+        self.writer.emit(myentry)
+
+    def finish(self, records, walltime, status):
+        """ Report the totals of the source, walltime in seconds """
+        with self.lock:
+            self.summary = dict(self.totals)
+            self.summary.update({
+                'pages': self.pages,
+                'records': records,
+                'walltime': round(walltime, 3),
+                'records_per_second': round(records/walltime, 3) if walltime > 0 else 0,
+                'status': status,
+                'success': int(status == 'OK'),
+                'timestamp': int(datetime.now(timezone.utc).timestamp()),
+                })
+            for key in ['latency', 'ttfb', 'decompress_time', 'parse_time', 'write_time']:
+                self.summary[key] = round(self.summary[key], 3)
+            myentry = {'type': 'source', 'source': self.section,
+                    'protocol': self.protocol, 'time': now()}
+            myentry.update(self.summary)
+        self.writer.emit(myentry)
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+def prom_label(value):
+    """ Escape a Prometheus label value """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,79 @@
+"""
+PURPOSE:
+    Persistent state of the harvest of each source (section in the
+    configuration file). Used to harvest incrementally, i.e. to compute
+    the from= argument of OAI-PMH requests from the start time of the last
+    successful harvest.
+
+NOTES:
+    - The state is kept in a JSON file next to the configuration file,
+      e.g. sites2harvest.yml -> sites2harvest-state.json
+    - Each section holds:
+        - last_start: start of last successful harvest (UTC, ISO 8601)
+        - granularity: datestamp granularity reported by OAI-PMH Identify
+        - records: number of records harvested in the last harvest
+        - complete: whether all records at the source were seen in the
+          last harvest (not incremental), see check4outdated.py
+        - checkpoint: paging position of an unfinished harvest, i.e. the
+          position to continue from, the from argument and start time of
+          the harvest
+
+"""
+
+import os
+import json
+import threading
+from datetime import datetime, timezone
+
+DAY_GRANULARITY = 'YYYY-MM-DD'
+SECONDS_GRANULARITY = 'YYYY-MM-DDThh:mm:ssZ'
+
+def state_filename(cfgfile):
+    """
+    Name of the state file belonging to a configuration file.
+    """
+    return os.path.splitext(cfgfile)[0]+'-state.json'
+
+def format_from(last_start, granularity=None):
+    """
+    Create the OAI-PMH from= argument from a ISO 8601 timestamp, using the
+    granularity supported by the endpoint. Day granularity is used if the
+    granularity is unknown as all endpoints have to support it.
+    """
+    mytime = datetime.fromisoformat(last_start).astimezone(timezone.utc)
+    if granularity == SECONDS_GRANULARITY:
+        return mytime.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return mytime.strftime('%Y-%m-%d')
+
+class HarvestState(object):
+    """
+    Harvest state of all sections in a configuration. Access is
+    serialised, i.e. sections harvested concurrently can share an
+    instance.
+    """
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.lock = threading.Lock()
+        if os.path.exists(statefile):
+            with open(statefile, 'r') as myfile:
+                self.state = json.load(myfile)
+        else:
+            self.state = {}
+
+    def get(self, section):
+        """ Return a copy of the state of a section """
+        with self.lock:
+            return dict(self.state.get(section, {}))
+
+    def update(self, section, **kwargs):
+        """ Update the state of a section and write the state file """
+        with self.lock:
+            self.state.setdefault(section, {}).update(kwargs)
+            self.save()
+
+    def save(self):
+        """ Write the state file, replacing the old one atomically """
+        tmpfile = self.statefile+'.tmp'
+        with open(tmpfile, 'w') as myfile:
+            json.dump(self.state, myfile, indent=2, sort_keys=True)
+        os.replace(tmpfile, self.statefile)
@@ -0,0 +1,243 @@
+"""
+PURPOSE:
+    Shared HTTP client used by the harvesters. All requests go through one
+    pooled session, i.e. TCP/TLS connections are kept alive and reused per
+    host, and compressed transfer (gzip, deflate) is requested. Timeouts
+    and TLS verification are set per client, i.e. per source harvested.
+
+    Flow control is handled here as well. Responses 429 and 503 (and other
+    temporary server errors) are retried, honouring Retry-After if
+    provided and otherwise using exponential backoff with jitter. Requests
+    can be limited per host using a token bucket.
+
+NOTES:
+    - requests handles decompression of the content transparently, for
+      streaming use response.raw with decode_content set. To time
+      decompression, read response.raw without decoding and use
+      decode_content.
+    - Rate limits are shared by all clients towards the same host, if
+      configured differently the lowest rate is used.
+    - Responses can be captured, or replayed from a capture instead of
+      requesting them, see page_capture.py.
+    - Warnings about unverified TLS requests are only suppressed for the
+      hosts of sources not verified (verify False), see ignore_unverified.
+
+"""
+
+import threading
+import time
+import re
+import warnings
+import random
+import zlib
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_RETRIES = 3
+# Status codes indicating the server may answer later
+RETRY_STATUS = [429, 500, 502, 503, 504]
+# Never wait longer than this between retries, even if asked to
+MAX_WAIT = 600
+DEFAULT_HEADERS = {
+        'Accept-Encoding': 'gzip, deflate',
+        'User-Agent': 'mdharvest',
+        }
+
+_session = None
+_session_lock = threading.Lock()
+_limiters = {}
+_limiters_lock = threading.Lock()
+_unverified = set()
+_unverified_lock = threading.Lock()
+
+def get_session(poolsize=20):
+    """
+    Return the session shared by all clients in this process. Connections
+    are pooled per host, poolsize is the number of connections kept per
+    host.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=poolsize,
+                    pool_maxsize=poolsize)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers.update(DEFAULT_HEADERS)
+    return _session
+
+def get_ratelimiter(host, rate, burst=1):
+    """
+    Return the rate limiter for a host, creating it if needed. rate is
+    the number of requests per second.
+    """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(rate, burst)
+        elif rate < _limiters[host].rate:
+            _limiters[host].rate = rate
+        return _limiters[host]
+
+def ignore_unverified(host):
+    """
+    Don't warn about unverified TLS requests towards host, i.e. for
+    sources that have not asked for certificates to be verified. Other
+    hosts are still warned about.
+    """
+    with _unverified_lock:
+        if host in _unverified:
+            return
+        _unverified.add(host)
+        warnings.filterwarnings('ignore',
+                message="Unverified HTTPS request is being made to host '%s'"
+                % re.escape(host), category=InsecureRequestWarning)
+
+def retry_after(response):
+    """
+    Number of seconds the server asks us to wait (Retry-After header),
+    None if not provided or not understood.
+    """
+    value = response.headers.get('Retry-After')
+    if value == None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        mydate = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (mydate-datetime.now(timezone.utc)).total_seconds())
+
+def decode_content(content, encoding):
+    """
+    Decompress content received with Content-Encoding encoding, used when
+    the raw content is read to measure transfer and decompression
+    separately.
+    """
+    if encoding == None:
+        return content
+    encoding = encoding.strip().lower()
+    if encoding in ['', 'identity']:
+        return content
+    elif encoding in ['gzip', 'x-gzip']:
+        return zlib.decompress(content, 16+zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        # Servers send both zlib wrapped and raw deflate
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    raise IOError('Content-Encoding not supported: %s' % encoding)
+
+class RateLimiter(object):
+    """
+    Token bucket allowing rate requests per second on average, with
+    bursts of up to burst requests.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait until a request is allowed """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                        self.tokens+(now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                mywait = (1-self.tokens)/self.rate
+            time.sleep(mywait)
+
+class HarvestClient(object):
+    """
+    Client for HTTP requests towards a single source, using the shared
+    session.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, verify=True,
+            retries=DEFAULT_RETRIES, backoff=1, rate=None, burst=1,
+            logger=None, capture=None, replay=None):
+        self.timeout = timeout
+        self.verify = verify
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = rate
+        self.burst = burst
+        self.logger = logger
+        # Storage of responses (SourceCapture) and capture to replay
+        # (CaptureArchive)
+        self.capture = capture
+        self.replay = replay
+        self.session = get_session()
+
+    def get(self, URL, stream=False, auth=None, headers=None):
+        """
+        Send a GET request. Temporary failures are retried up to
+        self.retries times. Raises requests.exceptions.RequestException on
+        connection problems, other HTTP status codes are left to the
+        caller. If replaying, the response is read from the capture.
+        """
+        if self.replay != None:
+            return self.replay.get(URL)
+        if self.capture != None:
+            # The raw content is needed for storage
+            response = self.request(URL, True, auth, headers)
+            return self.capture.store(URL, response)
+        return self.request(URL, stream, auth, headers)
+
+    def request(self, URL, stream=False, auth=None, headers=None):
+        """ Send a GET request, retrying temporary failures """
+        if self.rate:
+            limiter = get_ratelimiter(urlparse(URL).hostname, self.rate,
+                    self.burst)
+        else:
+            limiter = None
+        if not self.verify:
+            ignore_unverified(urlparse(URL).hostname)
+        attempt = 0
+        while True:
+            if limiter != None:
+                limiter.acquire()
+            try:
+                response = self.session.get(URL, timeout=self.timeout,
+                        verify=self.verify, stream=stream, auth=auth,
+                        headers=headers)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                mywait = self.wait_time(attempt)
+                self.log('Request failed (%s), retrying in %.1f s', e, mywait)
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return response
+                mywait = retry_after(response)
+                if mywait == None:
+                    mywait = self.wait_time(attempt)
+                mywait = min(mywait, MAX_WAIT)
+                response.close()
+                self.log('Server responded %d, retrying in %.1f s',
+                        response.status_code, mywait)
+            time.sleep(mywait)
+            attempt += 1
+
+    def wait_time(self, attempt):
+        """ Exponential backoff with full jitter """
+        return random.uniform(0, min(MAX_WAIT, self.backoff*2**(attempt+1)))
+
+    def log(self, *args):
+        if self.logger != None:
+            self.logger.warning(*args)
@@ -0,0 +1,117 @@
+"""
+PURPOSE:
+    Transformation of harvested records to MMD. The stylesheet is chosen
+    from the metadata format harvested (mdkw in the configuration) and
+    collections are added to the MMD records created. Used by
+    xmltransform.py and by the harvester to write MMD records directly,
+    see the configuration key transform in run-harvest.py.
+
+NOTES:
+    - Stylesheets are found relative to the working directory.
+    - Stylesheets are compiled once per process, and again if modified,
+      see get_transform. Sources with different collections share the
+      compiled stylesheet, collections are added after the
+      transformation.
+    - lxml XSLT objects should not be applied concurrently, each thread
+      uses its own compiled transform.
+
+"""
+
+import os
+import threading
+from functools import partial
+import lxml.etree as ET
+
+XSLT_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
+MMD_NAMESPACE = 'http://www.met.no/schema/mmd'
+
+# Stylesheets by metadata format keyword
+STYLESHEETS = [
+        (['dif', 'dif_10', 'gcmd'], '../xslt/dif-to-mmd.xsl'),
+        (['iso', 'iso19139', 'iso19115'], '../xslt/iso-to-mmd.xsl'),
+        (['rdf'], '../xslt/dcat-to-mmd.xsl'),
+        (['MM2'], '../xslt/mm2-to-mmd.xsl'),
+        ]
+
+_transforms = {}
+_transforms_lock = threading.Lock()
+
+def get_stylesheet(mdkw):
+    """ Stylesheet converting records of format mdkw, None if not known """
+    for keywords, stylesheet in STYLESHEETS:
+        if mdkw in keywords:
+            return stylesheet
+    return None
+
+def get_transform(stylesheet):
+    """
+    Return the transform of a stylesheet, shared by all users in the
+    process. The stylesheet is compiled again if modified.
+    """
+    mypath = os.path.abspath(stylesheet)
+    mykey = (mypath, os.stat(mypath).st_mtime_ns)
+    with _transforms_lock:
+        if mykey not in _transforms:
+            for x in [x for x in _transforms if x[0] == mypath]:
+                del _transforms[x]
+            _transforms[mykey] = MMDTransform(stylesheet)
+        return _transforms[mykey]
+
+def add_collections(mmd, collections):
+    """
+    Add collections (comma separated) to a MMD document, after the first
+    mmd:collection element. The order is as when collections were added
+    to the stylesheet, i.e. the last collection first.
+    """
+    myroot = mmd.getroot()
+    myelement = myroot.find('.//{%s}collection' % MMD_NAMESPACE)
+    if myelement is None:
+        return
+    myparent = myelement.getparent()
+    for coll in collections.replace(' ','').split(','):
+        myelem = ET.Element('{%s}collection' % MMD_NAMESPACE)
+        myelem.text = coll
+        myelem.tail = myelement.tail
+        myparent.insert(myparent.index(myelement)+1, myelem)
+    return
+
+class MMDTransform(object):
+    """
+    Transformation of records to MMD using a stylesheet, callable as
+    ET.XSLT with collections to add.
+    """
+    def __init__(self, stylesheet):
+        self.stylesheet = stylesheet
+        parser = ET.XMLParser(remove_blank_text=True)
+        # Parsed once, compiled once per thread
+        self.xslt = ET.parse(stylesheet, parser)
+        self.local = threading.local()
+        self.collections = len(self.xslt.xpath(".//xsl:element[@name='mmd:collection']",
+            namespaces={'xsl':XSLT_NAMESPACE})) > 0
+
+    def __call__(self, doc, collections=None, **kwargs):
+        mytransform = getattr(self.local, 'transform', None)
+        if mytransform == None:
+            mytransform = self.local.transform = ET.XSLT(self.xslt)
+        newxml = mytransform(doc, **kwargs)
+        if collections and newxml.getroot() is not None:
+            add_collections(newxml, collections)
+        return newxml
+
+    def with_collections(self, collections):
+        """
+        Return the transform adding collections. Raises ValueError if the
+        stylesheet doesn't create mmd:collection elements.
+        """
+        if not collections:
+            return self
+        if not self.collections:
+            raise ValueError("Can't find the mmd:collection element in %s" % self.stylesheet)
+        return partial(self, collections=collections)
+
+def get_mmdid(mmd):
+    """ Return the metadata_identifier of a MMD document, None if missing """
+    myroot = mmd.getroot()
+    if myroot is None:
+        return None
+    return myroot.findtext('{%s}metadata_identifier' % MMD_NAMESPACE)
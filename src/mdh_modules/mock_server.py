@@ -0,0 +1,366 @@
+"""
+PURPOSE:
+    Local stand-in for the data centres harvested, used to benchmark the
+    harvester without network access. Serves synthetic records through
+    OAI-PMH (Identify, ListRecords, ListIdentifiers, GetRecord), OGC CSW
+    (GetRecords, optionally constrained on Modified, and brief or summary
+    element sets, GetRecordById) and OpenSearch (Atom feeds). Records are generated from
+    their number, i.e. the same settings always give the same responses.
+
+NOTES:
+    - Endpoints: /oai, /csw and /opensearch on the address returned by
+      MockServer.start().
+    - Record format follows the OAI-PMH metadataPrefix, DIF unless it
+      contains iso. CSW records are always ISO.
+    - Settings:
+        - records: number of records
+        - pagesize: records per page
+        - size: approximate size of each record in bytes
+        - deleted: fraction of records reported as deleted (OAI-PMH)
+        - fail: fraction of requests answered with 503 and Retry-After
+        - delay: seconds to wait before each response
+        - compress: gzip responses if the client accepts it
+        - seed: seed used for deleted records and failures
+        - cswfilter: support the CQL constraint Modified >= '<date>',
+          otherwise constraints are answered with an exception report
+
+"""
+
+import gzip
+import random
+import re
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+BASE_TIME = datetime(2020, 1, 1)
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do '
+        'eiusmod tempor incididunt ut labore et dolore magna aliqua. ')
+
+DIF_RECORD = '''<DIF xmlns="http://gcmd.gsfc.nasa.gov/Aboutus/xml/dif/">
+<Entry_ID>{id}</Entry_ID>
+<Entry_Title>Synthetic dataset {num}</Entry_Title>
+<Summary><Abstract>{text}</Abstract></Summary>
+<Last_DIF_Revision_Date>{date}</Last_DIF_Revision_Date>
+</DIF>'''
+
+ISO_RECORD = '''<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+<gmd:fileIdentifier><gco:CharacterString>{id}</gco:CharacterString></gmd:fileIdentifier>
+<gmd:dateStamp><gco:DateTime>{datestamp}</gco:DateTime></gmd:dateStamp>
+<gmd:identificationInfo><gmd:MD_DataIdentification>
+<gmd:citation><gmd:CI_Citation><gmd:title><gco:CharacterString>Synthetic dataset {num}</gco:CharacterString></gmd:title></gmd:CI_Citation></gmd:citation>
+<gmd:abstract><gco:CharacterString>{text}</gco:CharacterString></gmd:abstract>
+</gmd:MD_DataIdentification></gmd:identificationInfo>
+</gmd:MD_Metadata>'''
+
+CSW_BRIEF = '''<csw:{element} xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dct="http://purl.org/dc/terms/">
+<dc:identifier>{id}</dc:identifier>
+<dc:title>Synthetic dataset {num}</dc:title>
+<dc:type>dataset</dc:type>{modified}
+</csw:{element}>'''
+
+CSW_EXCEPTION = '''<?xml version="1.0" encoding="UTF-8"?>
+<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows" version="1.2.0">
+<ows:Exception exceptionCode="{code}" locator="{locator}">
+<ows:ExceptionText>{text}</ows:ExceptionText>
+</ows:Exception>
+</ows:ExceptionReport>
+'''
+
+# Constraints understood (CQL_TEXT)
+MODIFIED_CONSTRAINT = re.compile(r"^\s*(?:\w+:)?Modified\s*>=\s*'([^']+)'\s*$", re.I)
+
+ATOM_ENTRY = '''<entry>
+<id>{id}</id>
+<title>Synthetic dataset {num}</title>
+<updated>{datestamp}</updated>
+<summary>{text}</summary>
+</entry>'''
+
+class MockServer(object):
+    """
+    Synthetic OAI-PMH, CSW and OpenSearch server running in a thread.
+    """
+    def __init__(self, records=1000, pagesize=100, size=2000, deleted=0.,
+            fail=0., delay=0., compress=True, seed=0, cswfilter=True):
+        self.records = records
+        self.pagesize = pagesize
+        self.size = size
+        self.deleted = deleted
+        self.fail = fail
+        self.delay = delay
+        self.compress = compress
+        self.seed = seed
+        self.cswfilter = cswfilter
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # Number of requests and failures served
+        self.requests = 0
+        self.failures = 0
+        self.text = (LOREM*(size//len(LOREM)+1))[:max(0, size-500)]
+        self.httpd = None
+
+    def start(self):
+        """ Start serving on a free local port, returns the base URL """
+        myserver = self
+        class Handler(MockHandler):
+            server_data = myserver
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        mythread = threading.Thread(target=self.httpd.serve_forever,
+                name='mock-server', daemon=True)
+        mythread.start()
+        return 'http://127.0.0.1:%d' % self.httpd.server_port
+
+    def stop(self):
+        if self.httpd != None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def identifier(self, num):
+        return 'mock-%07d' % num
+
+    def datestamp(self, num):
+        return (BASE_TIME+timedelta(minutes=num)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def is_deleted(self, num):
+        if not self.deleted:
+            return False
+        return random.Random(self.seed*10000019+num).random() < self.deleted
+
+    def should_fail(self):
+        """ Decide whether the current request fails """
+        with self.lock:
+            self.requests += 1
+            if self.fail and self.rng.random() < self.fail:
+                self.failures += 1
+                return True
+        return False
+
+    def record(self, num, fmt):
+        """ Metadata of a record in format fmt (dif or iso) """
+        if fmt == 'iso':
+            mytemplate = ISO_RECORD
+        else:
+            mytemplate = DIF_RECORD
+        return mytemplate.format(id=self.identifier(num), num=num,
+                text=self.text, datestamp=self.datestamp(num),
+                date=self.datestamp(num)[:10])
+
+    # OAI-PMH
+    def oaipmh(self, args):
+        verb = args.get('verb')
+        prefix = args.get('metadataPrefix', 'dif')
+        fmt = 'iso' if 'iso' in prefix else 'dif'
+        if verb == 'Identify':
+            return self.oaipmh_response(verb, '''<Identify>
+<repositoryName>mdharvest mock server</repositoryName>
+<baseURL>/oai</baseURL>
+<protocolVersion>2.0</protocolVersion>
+<earliestDatestamp>%s</earliestDatestamp>
+<deletedRecord>persistent</deletedRecord>
+<granularity>YYYY-MM-DDThh:mm:ssZ</granularity>
+</Identify>''' % self.datestamp(0))
+        elif verb in ['ListRecords', 'ListIdentifiers']:
+            start = 0
+            if 'resumptionToken' in args:
+                try:
+                    start = int(args['resumptionToken'])
+                except ValueError:
+                    return self.oaipmh_error(verb, 'badResumptionToken',
+                            'Invalid resumptionToken')
+                if start < 0 or start >= self.records:
+                    return self.oaipmh_error(verb, 'badResumptionToken',
+                            'Invalid resumptionToken')
+            if self.records == 0:
+                return self.oaipmh_error(verb, 'noRecordsMatch',
+                        'No records')
+            end = min(start+self.pagesize, self.records)
+            items = []
+            for num in range(start, end):
+                if verb == 'ListIdentifiers':
+                    items.append(self.oaipmh_header(num))
+                else:
+                    items.append(self.oaipmh_record(num, fmt))
+            if end < self.records:
+                token = '<resumptionToken completeListSize="%d" cursor="%d">%d</resumptionToken>' % (self.records, start, end)
+            else:
+                token = '<resumptionToken completeListSize="%d" cursor="%d"/>' % (self.records, start)
+            return self.oaipmh_response(verb, '<%s>\n%s\n%s\n</%s>' % (verb,
+                '\n'.join(items), token, verb))
+        elif verb == 'GetRecord':
+            myid = args.get('identifier', '')
+            try:
+                num = int(myid.rsplit('-', 1)[1])
+            except (IndexError, ValueError):
+                num = -1
+            if num < 0 or num >= self.records:
+                return self.oaipmh_error(verb, 'idDoesNotExist',
+                        'Unknown identifier')
+            return self.oaipmh_response(verb, '<GetRecord>\n%s\n</GetRecord>'
+                    % self.oaipmh_record(num, fmt))
+        return self.oaipmh_error(verb, 'badVerb', 'Illegal verb')
+
+    def oaipmh_header(self, num):
+        if self.is_deleted(num):
+            mystatus = ' status="deleted"'
+        else:
+            mystatus = ''
+        return '<header%s><identifier>oai:mock:%s</identifier><datestamp>%s</datestamp></header>' % (mystatus, self.identifier(num), self.datestamp(num))
+
+    def oaipmh_record(self, num, fmt):
+        if self.is_deleted(num):
+            return '<record>%s</record>' % self.oaipmh_header(num)
+        return '<record>%s\n<metadata>\n%s\n</metadata>\n</record>' % (
+                self.oaipmh_header(num), self.record(num, fmt))
+
+    def oaipmh_response(self, verb, content):
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>%s</responseDate>
+<request verb="%s">/oai</request>
+%s
+</OAI-PMH>
+''' % (self.datestamp(0), escape(verb or ''), content)
+
+    def oaipmh_error(self, verb, code, message):
+        return self.oaipmh_response(verb, '<error code="%s">%s</error>'
+                % (code, message))
+
+    # OGC CSW
+    def csw(self, args):
+        """ Returns status code and content """
+        if args.get('request', '').lower() == 'getrecordbyid':
+            return self.csw_byid(args)
+        # Records matching are numbered first to self.records-1
+        first = 0
+        if args.get('constraint'):
+            mymatch = MODIFIED_CONSTRAINT.match(args['constraint'])
+            if not self.cswfilter or mymatch == None:
+                return 400, CSW_EXCEPTION.format(code='InvalidParameterValue',
+                        locator='constraint', text='Constraint not supported')
+            # Datestamps increase with the record number
+            first = bisect.bisect_left(range(self.records), mymatch.group(1),
+                    key=self.datestamp)
+        matched = self.records-first
+        start = max(1, int(args.get('startposition', 1)))
+        pagesize = int(args.get('maxrecords', self.pagesize))
+        end = min(start+pagesize-1, matched)
+        elementset = args.get('elementsetname', 'full').lower()
+        if elementset in ['brief', 'summary']:
+            items = [self.csw_brief(first+num-1, elementset)
+                    for num in range(start, end+1)]
+        else:
+            items = [self.record(first+num-1, 'iso')
+                    for num in range(start, end+1)]
+        if end < matched:
+            nextRecord = end+1
+        else:
+            nextRecord = 0
+        return 200, '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" version="2.0.2">
+<csw:SearchStatus timestamp="%s"/>
+<csw:SearchResults numberOfRecordsMatched="%d" numberOfRecordsReturned="%d" elementSet="%s" nextRecord="%d">
+%s
+</csw:SearchResults>
+</csw:GetRecordsResponse>
+''' % (self.datestamp(0), matched, len(items), elementset, nextRecord,
+        '\n'.join(items))
+
+    def csw_byid(self, args):
+        """ GetRecordById, unknown identifiers are left out """
+        items = []
+        for myid in args.get('id', '').split(','):
+            try:
+                num = int(myid.rsplit('-', 1)[1])
+            except (IndexError, ValueError):
+                continue
+            if 0 <= num < self.records:
+                items.append(self.record(num, 'iso'))
+        return 200, '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2">
+%s
+</csw:GetRecordByIdResponse>
+''' % '\n'.join(items)
+
+    def csw_brief(self, num, elementset):
+        """ Dublin Core record of the brief or summary element set """
+        if elementset == 'summary':
+            return CSW_BRIEF.format(element='SummaryRecord',
+                    id=self.identifier(num), num=num,
+                    modified='\n<dct:modified>%s</dct:modified>' % self.datestamp(num))
+        return CSW_BRIEF.format(element='BriefRecord',
+                id=self.identifier(num), num=num, modified='')
+
+    # OpenSearch
+    def opensearch(self, args):
+        start = max(0, int(args.get('start', 0)))
+        rows = int(args.get('rows', self.pagesize))
+        end = min(start+rows, self.records)
+        items = [ATOM_ENTRY.format(id=self.identifier(num), num=num,
+            datestamp=self.datestamp(num), text=self.text)
+            for num in range(start, end)]
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
+<title>mdharvest mock server</title>
+<opensearch:totalResults>%d</opensearch:totalResults>
+<opensearch:startIndex>%d</opensearch:startIndex>
+<opensearch:itemsPerPage>%d</opensearch:itemsPerPage>
+%s
+</feed>
+''' % (self.records, start, rows, '\n'.join(items))
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Request handler, server_data is the MockServer """
+    server_data = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        mydata = self.server_data
+        myurl = urlparse(self.path)
+        # CSW parameters are case insensitive
+        args = dict((k, v[0]) for k, v in parse_qs(myurl.query).items())
+        if myurl.path.startswith('/csw'):
+            args = dict((k.lower(), v) for k, v in args.items())
+        if mydata.delay:
+            time.sleep(mydata.delay)
+        if mydata.should_fail():
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            status = 200
+            if myurl.path.startswith('/oai'):
+                content = mydata.oaipmh(args)
+            elif myurl.path.startswith('/csw'):
+                status, content = mydata.csw(args)
+            elif myurl.path.startswith('/opensearch'):
+                content = mydata.opensearch(args)
+            else:
+                self.send_error(404)
+                return
+        except ValueError:
+            self.send_error(400)
+            return
+        content = content.encode('UTF-8')
+        self.send_response(status)
+        if myurl.path.startswith('/opensearch'):
+            self.send_header('Content-Type', 'application/atom+xml; charset=UTF-8')
+        else:
+            self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        if mydata.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content, compresslevel=6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
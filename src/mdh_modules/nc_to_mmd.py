@@ -19,8 +19,8 @@ import sys
 import os
 import re
 import validators
-import urllib.request as ul
 import json
+from mdh_modules.http_client import HarvestClient
 
 class Nc_to_mmd(object):
 
@@ -377,8 +377,8 @@ class Nc_to_mmd(object):
         queryror = "https://api.ror.org/v2/organizations/"
         ror_id = ror.split("ror.org/")[-1]
         try:
-            with ul.urlopen(queryror+ror_id, timeout=10) as response:
-                ror_info = json.load(response)['names']
+            with HarvestClient(timeout=10).get(queryror+ror_id) as response:
+                ror_info = response.json()['names']
                 for n in ror_info:
                     if n.get('lang') == 'en':
                         if 'ror_display' in n.get('types'):
@@ -1073,8 +1073,8 @@ class Nc_to_mmd(object):
         wigos_id = getattr(ncin, 'wigosId')
         querywigosid = "https://oscar.wmo.int/surface/rest/api/search/station?wigosId="
         try:
-            with ul.urlopen(querywigosid+wigos_id, timeout=10) as response:
-                wigos_data = json.load(response)
+            with HarvestClient(timeout=10).get(querywigosid+wigos_id) as response:
+                wigos_data = response.json()
                 station_name = wigos_data['stationSearchResults'][0]['name']
                 station_url = 'https://oscar.wmo.int/surface/#/search/station/stationReportDetails/'+ wigos_id
                 myel = ET.SubElement(myxmltree,ET.QName(mynsmap['mmd'],'related_information'))
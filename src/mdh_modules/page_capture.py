@@ -0,0 +1,177 @@
+"""
+PURPOSE:
+    Capture of the raw pages harvested and offline replay. When capturing,
+    each HTTP response received is stored compressed together with the
+    request URL and the response headers. A capture can then be replayed,
+    i.e. the harvester is run with responses read from the capture
+    instead of the network. This allows reprocessing of harvested
+    information without harvesting the providers again, and gives
+    realistic fixtures for benchmarking.
+
+NOTES:
+    - A capture is a directory holding:
+        - index.jsonl: one line per request harvested (type request,
+          section, baseURL, records, resume and modified) and per page
+          (type page, section, url, status, headers, encoding and file)
+        - pages/: the content of each page, as received if the transfer
+          was compressed, otherwise gzip compressed
+    - Pages are replayed in the order captured. If the same URL was
+      captured several times, the captures are returned in turn, the last
+      one is repeated.
+    - Capture and replay are connected to HarvestClient, i.e. all
+      harvesting strategies are supported.
+
+"""
+
+import os
+import io
+import gzip
+import json
+import threading
+from datetime import datetime, timezone
+import requests
+from requests.structures import CaseInsensitiveDict
+import urllib3
+
+INDEX_NAME = 'index.jsonl'
+PAGES_DIR = 'pages'
+
+def make_response(URL, status, headers, content):
+    """
+    Create a response from content as received, i.e. before
+    decompression. Behaves as a response requested with stream set.
+    """
+    myraw = urllib3.HTTPResponse(body=io.BytesIO(content), headers=headers,
+            status=status, preload_content=False, decode_content=False)
+    myresponse = requests.Response()
+    myresponse.raw = myraw
+    myresponse.status_code = status
+    myresponse.headers = CaseInsensitiveDict(headers)
+    myresponse.url = URL
+    myresponse.reason = 'Replayed'
+    return myresponse
+
+class CaptureArchive(object):
+    """
+    Archive of captured pages. Opened for capture (mode w) or replay
+    (mode r). Access is serialised, sources harvested concurrently can
+    share an instance.
+    """
+    def __init__(self, directory, mode='r'):
+        self.directory = directory
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.served = {}
+        self.requests = {}
+        self.counter = 0
+        self.myfile = None
+        indexfile = os.path.join(directory, INDEX_NAME)
+        if os.path.exists(indexfile):
+            with open(indexfile, 'r') as myfile:
+                for myline in myfile:
+                    myentry = json.loads(myline)
+                    if myentry['type'] == 'request':
+                        self.requests[myentry['section']] = myentry
+                    else:
+                        self.pages.setdefault(myentry['url'], []).append(myentry)
+                        self.counter += 1
+        elif mode == 'r':
+            raise IOError('No capture found in %s' % directory)
+        if mode == 'w':
+            os.makedirs(os.path.join(directory, PAGES_DIR), exist_ok=True)
+            self.myfile = open(indexfile, 'a')
+
+    def source(self, section):
+        """ Return the capture of a source (section) """
+        return SourceCapture(self, section)
+
+    def emit(self, entry):
+        entry['time'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self.myfile.write(json.dumps(entry, sort_keys=True)+'\n')
+        self.myfile.flush()
+
+    def start(self, section, baseURL, records, resume=None, modified=None):
+        """
+        Register the initial request of a source, the paging position
+        if resuming and the date of incremental CSW harvests.
+        """
+        with self.lock:
+            self.emit({'type': 'request', 'section': section,
+                'baseURL': baseURL, 'records': records, 'resume': resume,
+                'modified': modified})
+
+    def request(self, section):
+        """
+        Return the initial request of a source as a dictionary with
+        baseURL and records, None if not captured.
+        """
+        return self.requests.get(section)
+
+    def store(self, URL, response, section=None):
+        """
+        Store a response. The content is read completely, a response
+        giving the same content is returned.
+        """
+        content = response.raw.read(decode_content=False)
+        response.close()
+        encoding = response.headers.get('Content-Encoding', '').strip().lower()
+        if encoding in ['', 'identity']:
+            mydata = gzip.compress(content)
+            encoding = None
+        else:
+            mydata = content
+        with self.lock:
+            self.counter += 1
+            filename = os.path.join(PAGES_DIR, '%07d.%s' % (self.counter,
+                encoding or 'gzip'))
+        with open(os.path.join(self.directory, filename), 'wb') as myfile:
+            myfile.write(mydata)
+        with self.lock:
+            self.emit({'type': 'page', 'section': section, 'url': URL,
+                'status': response.status_code,
+                'headers': dict(response.headers),
+                'encoding': encoding, 'file': filename})
+        return make_response(URL, response.status_code,
+                dict(response.headers), content)
+
+    def get(self, URL):
+        """
+        Return the response captured for URL. Raises
+        requests.exceptions.ConnectionError if not captured.
+        """
+        with self.lock:
+            myentries = self.pages.get(URL)
+            if not myentries:
+                raise requests.exceptions.ConnectionError(
+                        'Not found in capture: %s' % URL)
+            mycount = self.served.get(URL, 0)
+            self.served[URL] = mycount+1
+            myentry = myentries[min(mycount, len(myentries)-1)]
+        with open(os.path.join(self.directory, myentry['file']), 'rb') as myfile:
+            content = myfile.read()
+        if myentry['encoding'] == None:
+            content = gzip.decompress(content)
+        myheaders = dict((k, v) for k, v in myentry['headers'].items()
+                if k.lower() not in ['content-length', 'transfer-encoding'])
+        myheaders['Content-Length'] = str(len(content))
+        return make_response(URL, myentry['status'], myheaders, content)
+
+    def close(self):
+        if self.myfile != None:
+            self.myfile.close()
+            self.myfile = None
+
+class SourceCapture(object):
+    """
+    Capture of the pages of a single source.
+    """
+    def __init__(self, archive, section):
+        self.archive = archive
+        self.section = section
+
+    def start(self, baseURL, records, resume=None, modified=None):
+        self.archive.start(self.section, baseURL, records, resume, modified)
+
+    def store(self, URL, response):
+        return self.archive.store(URL, response, self.section)
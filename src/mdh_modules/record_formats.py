@@ -0,0 +1,154 @@
+"""
+PURPOSE:
+    Registry of the metadata formats harvested. Each format knows how to
+    find the records in a harvested page and how to extract the protocol
+    identifier, datestamp, deleted status, native identifier and the
+    metadata element (payload) of a record. All XPath expressions are
+    compiled once when this module is loaded.
+
+NOTES:
+    - To support a new format, create a RecordFormat and add it to
+      FORMATS. Expressions are evaluated as follows:
+        - records: on the harvested document
+        - identifier, datestamp, deleted, payload: on each record
+        - nativeid: on the payload, expressions are tried in order and
+          the first non empty value is used
+    - If identifier is not provided (CSW), the native identifier is used.
+    - If nativeid is not provided (DCAT), the identifier is used.
+
+"""
+
+from collections import namedtuple
+import lxml.etree as ET
+
+NAMESPACES = {
+        'oai':'http://www.openarchives.org/OAI/2.0/',
+        'csw':'http://www.opengis.net/cat/csw/2.0.2',
+        'dif':'http://gcmd.gsfc.nasa.gov/Aboutus/xml/dif/',
+        'gmd':'http://www.isotc211.org/2005/gmd',
+        'gmi':'http://www.isotc211.org/2005/gmi',
+        'gco':'http://www.isotc211.org/2005/gco',
+        'mdb':'http://standards.iso.org/iso/19115/-3/mdb/2.0',
+        'mcc':'http://standards.iso.org/iso/19115/-3/mcc/1.0',
+        'gco3':'http://standards.iso.org/iso/19115/-3/gco/1.0',
+        'cit':'http://standards.iso.org/iso/19115/-3/cit/2.0',
+        'dcat':'http://www.w3.org/ns/dcat#',
+        'rdf':'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+        'dc':'http://purl.org/dc/elements/1.1/',
+        'dct':'http://purl.org/dc/terms/',
+        'atom':'http://www.w3.org/2005/Atom',
+        'opensearch':'http://a9.com/-/spec/opensearch/1.1/',
+        }
+
+# Values extracted from a harvested record
+HarvestedRecord = namedtuple('HarvestedRecord',
+        ['identifier', 'datestamp', 'deleted', 'nativeid', 'payload'])
+
+def compile_xpath(expr):
+    """ Compile an XPath expression using the known namespaces """
+    if expr == None:
+        return None
+    return ET.XPath(expr, namespaces=NAMESPACES, smart_strings=False)
+
+class RecordFormat(object):
+    """
+    Extraction of records from harvested documents for one format.
+    """
+    def __init__(self, name, records, payload, nativeid=None,
+            identifier=None, datestamp=None, deleted=None):
+        self.name = name
+        self.records = compile_xpath(records)
+        self.payload = compile_xpath(payload)
+        self.nativeid = [compile_xpath(x) for x in (nativeid or [])]
+        self.identifier = compile_xpath(identifier)
+        self.datestamp = compile_xpath(datestamp)
+        self.deleted = compile_xpath(deleted)
+
+    def find_records(self, dom):
+        """ Return the records in a harvested document """
+        return self.records(dom)
+
+    def extract(self, record):
+        """ Extract the values of a record as a HarvestedRecord """
+        identifier = datestamp = nativeid = payload = None
+        deleted = False
+        if self.identifier != None:
+            identifier = self.identifier(record).strip() or None
+        if self.datestamp != None:
+            datestamp = self.datestamp(record).strip() or None
+        if self.deleted != None:
+            deleted = self.deleted(record)
+        if deleted:
+            return HarvestedRecord(identifier, datestamp, True, None, None)
+        mypayload = self.payload(record)
+        if len(mypayload) > 0:
+            payload = mypayload[0]
+            for myxpath in self.nativeid:
+                nativeid = myxpath(payload).strip() or None
+                if nativeid != None:
+                    break
+        if not self.nativeid:
+            nativeid = identifier
+        if identifier == None:
+            identifier = nativeid
+        return HarvestedRecord(identifier, datestamp, False, nativeid, payload)
+
+# Header of OAI-PMH records, common to all formats
+OAI_RECORDS = '/oai:OAI-PMH/oai:ListRecords/oai:record'
+OAI_IDENTIFIER = 'string(oai:header/oai:identifier)'
+OAI_DATESTAMP = 'string(oai:header/oai:datestamp)'
+OAI_DELETED = "boolean(oai:header[@status='deleted'])"
+
+def oaipmh_format(name, payload, nativeid=None):
+    """ Create the RecordFormat of a metadata format harvested by OAI-PMH """
+    return RecordFormat(name, OAI_RECORDS, payload, nativeid,
+            identifier=OAI_IDENTIFIER, datestamp=OAI_DATESTAMP,
+            deleted=OAI_DELETED)
+
+ISO_NATIVEID = ['string(gmd:fileIdentifier/gco:CharacterString)']
+ISO3_NATIVEID = ['string(mdb:metadataIdentifier/mcc:MD_Identifier/mcc:code/gco3:CharacterString)']
+
+FORMATS = {
+        # DIF 10 nests the identifier in Entry_ID/Short_Name
+        'dif': oaipmh_format('dif', 'oai:metadata/dif:DIF',
+            ['string(dif:Entry_ID/dif:Short_Name)', 'string(dif:Entry_ID)']),
+        'iso': oaipmh_format('iso',
+            'oai:metadata/gmd:MD_Metadata|oai:metadata/gmi:MI_Metadata',
+            ISO_NATIVEID),
+        'iso19115-3': oaipmh_format('iso19115-3', 'oai:metadata/mdb:MD_Metadata',
+            ISO3_NATIVEID),
+        # Not sure how identifiers are handled in DCAT, using the OAI identifier
+        'rdf': oaipmh_format('rdf', 'oai:metadata/rdf:RDF'),
+        # Records of CSW GetRecords and GetRecordById responses
+        # (outputSchema ISO)
+        'csw-iso': RecordFormat('csw-iso',
+            '/csw:GetRecordsResponse/csw:SearchResults/*[self::gmd:MD_Metadata or self::gmi:MI_Metadata or self::mdb:MD_Metadata]'
+            '|/csw:GetRecordByIdResponse/*[self::gmd:MD_Metadata or self::gmi:MI_Metadata or self::mdb:MD_Metadata]',
+            'self::*',
+            ISO_NATIVEID+ISO3_NATIVEID,
+            datestamp='string(gmd:dateStamp/gco:DateTime|gmd:dateStamp/gco:Date|mdb:dateInfo/cit:CI_Date/cit:date/gco3:DateTime)'),
+        # Dublin Core records of CSW GetRecords responses (elementSetName
+        # brief or summary), used to list identifiers
+        'csw-brief': RecordFormat('csw-brief',
+            '/csw:GetRecordsResponse/csw:SearchResults/*[self::csw:BriefRecord or self::csw:SummaryRecord or self::csw:Record]',
+            'self::*', ['string(dc:identifier)'],
+            datestamp='string(dct:modified)'),
+        # Entries of OpenSearch (Atom) responses, files have been named
+        # by the title of the entry
+        'opensearch': RecordFormat('opensearch', '/atom:feed/atom:entry',
+            'self::*', ['string(atom:title)', 'string(atom:id)'],
+            identifier='string(atom:id)', datestamp='string(atom:updated)'),
+        }
+
+def get_format(srcfmt):
+    """
+    Return the RecordFormat for a metadata format keyword (mdkw in the
+    configuration). Keywords not registered are matched on content, e.g.
+    iso19139 is handled as iso. Returns None if not supported.
+    """
+    if srcfmt in FORMATS:
+        return FORMATS[srcfmt]
+    for name in ['iso19115-3', 'dif', 'iso', 'rdf']:
+        if name in srcfmt:
+            return FORMATS[name]
+    return None
@@ -0,0 +1,215 @@
+"""
+PURPOSE:
+    Index of records harvested from a source. For each record the
+    identifier used by the protocol (OAI-PMH identifier or CSW
+    fileIdentifier), the native record identifier (DIF Entry_ID, ISO
+    fileIdentifier), the MMD metadata_identifier, the datestamp of the
+    last version harvested and the file written are kept. This allows
+    selective harvesting of new and changed records only, and direct
+    lookup of the files affected when records are deleted.
+
+    The index is also the manifest of the files written. The checksum
+    (SHA-256 of the canonical XML, C14N) of each file allows unchanged
+    records to be skipped instead of rewritten, and the time each record
+    was last seen at the source replaces the modification time of the
+    file when checking for outdated records.
+
+NOTES:
+    - The index is a SQLite database in the raw directory of the source.
+    - Access is serialised, the index can be shared by threads.
+    - The MMD metadata_identifier is added by xmltransform.py, or by the
+      harvester if records are transformed while harvesting.
+    - The files written in the last harvest are listed, one per line, in
+      .mdharvest-changed.txt in the raw directory.
+    - Indexes created by earlier versions are extended with the columns
+      missing.
+
+"""
+
+import os
+import sqlite3
+import threading
+
+INDEX_NAME = '.mdharvest-index.sqlite'
+CHANGED_NAME = '.mdharvest-changed.txt'
+
+def index_filename(outputDir):
+    """
+    Name of the index belonging to a raw directory.
+    """
+    return os.path.join(outputDir, INDEX_NAME)
+
+def changed_filename(outputDir):
+    """
+    Name of the list of files written (new or changed records) in the last
+    harvest of a raw directory.
+    """
+    return os.path.join(outputDir, CHANGED_NAME)
+
+class RecordIndex(object):
+    """
+    Persistent index of harvested records.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        mydir = os.path.dirname(filename)
+        if mydir and not os.path.isdir(mydir):
+            os.makedirs(mydir, exist_ok=True)
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS records (
+            identifier TEXT PRIMARY KEY,
+            nativeid TEXT,
+            mmdid TEXT,
+            datestamp TEXT,
+            deleted INTEGER DEFAULT 0,
+            filename TEXT,
+            checksum TEXT,
+            last_seen TEXT,
+            settings TEXT)""")
+        mycolumns = [x[1] for x in self.conn.execute("PRAGMA table_info(records)")]
+        for mycol in ['checksum', 'last_seen', 'settings']:
+            if mycol not in mycolumns:
+                self.conn.execute("ALTER TABLE records ADD COLUMN %s TEXT" % mycol)
+        for mycol in ['nativeid', 'mmdid', 'filename']:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS records_%s ON records (%s)"
+                    % (mycol, mycol))
+        self.conn.commit()
+
+    def update(self, identifier, datestamp, filename=None, deleted=False,
+            nativeid=None, checksum=None, last_seen=None):
+        """
+        Register a harvested (or deleted) record. Filename, native
+        identifier, checksum and last seen are kept if not provided. The
+        checksum of deleted records is cleared, i.e. a record restored
+        with the same content is written again.
+        """
+        with self.lock:
+            self.conn.execute("""INSERT INTO records
+                (identifier, nativeid, datestamp, deleted, filename,
+                checksum, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(identifier) DO UPDATE SET
+                nativeid=COALESCE(excluded.nativeid, records.nativeid),
+                datestamp=excluded.datestamp,
+                deleted=excluded.deleted,
+                filename=COALESCE(excluded.filename, records.filename),
+                checksum=CASE WHEN excluded.deleted THEN NULL
+                    ELSE COALESCE(excluded.checksum, records.checksum) END,
+                last_seen=COALESCE(excluded.last_seen, records.last_seen)""",
+                (identifier, nativeid, datestamp, int(deleted), filename,
+                    checksum, last_seen))
+
+    def touch(self, identifiers, last_seen):
+        """
+        Register records as seen at the source without harvesting them,
+        e.g. when listed by identifier only.
+        """
+        with self.lock:
+            self.conn.executemany("UPDATE records SET last_seen=? WHERE identifier=?",
+                    ((last_seen, x) for x in identifiers))
+
+    def set_mmdid(self, filename, mmdid):
+        """
+        Register the MMD metadata_identifier of the record in filename.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE records SET mmdid=? WHERE filename=?",
+                    (mmdid, filename))
+
+    def set_settings(self, filename, settings):
+        """
+        Register the settings of the transformation (see
+        transform_manifest.transform_settings) of the record in filename.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE records SET settings=? WHERE filename=?",
+                    (settings, filename))
+
+    def clear_checksum(self, filename):
+        """
+        Forget the checksum of the record in filename, e.g. when set
+        inactive, so it is written again when harvested.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE records SET checksum=NULL WHERE filename=?",
+                    (filename,))
+
+    def files(self):
+        """
+        Return a list of identifier and filename of records with a file.
+        """
+        with self.lock:
+            return self.conn.execute("""SELECT identifier, filename
+                FROM records WHERE filename IS NOT NULL""").fetchall()
+
+    def set_filename(self, identifier, filename):
+        """
+        Register a new location of the file of a record, e.g. when
+        moved to another layout.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE records SET filename=? WHERE identifier=?",
+                    (filename, identifier))
+
+    def lookup(self, myid):
+        """
+        Find a record by protocol identifier, native identifier or MMD
+        metadata_identifier. Returns a dictionary or None if not found.
+        """
+        with self.lock:
+            for mycol in ['identifier', 'nativeid', 'mmdid']:
+                myrow = self.conn.execute("""SELECT identifier, nativeid,
+                    mmdid, datestamp, deleted, filename, checksum, last_seen
+                    FROM records WHERE %s=? LIMIT 1""" % mycol,
+                    (myid,)).fetchone()
+                if myrow != None:
+                    return dict(zip(['identifier', 'nativeid', 'mmdid',
+                        'datestamp', 'deleted', 'filename', 'checksum',
+                        'last_seen'], myrow))
+        return None
+
+    def checksum(self, filename, settings=None):
+        """
+        Return the checksum of the content of filename, None if not
+        known or deleted. If settings is given, None is returned too if
+        the record was not transformed with these settings.
+        """
+        with self.lock:
+            myrow = self.conn.execute("""SELECT checksum FROM records
+                WHERE filename=? AND checksum IS NOT NULL AND deleted=0
+                AND (? IS NULL OR settings=?) LIMIT 1""",
+                (filename, settings, settings)).fetchone()
+        if myrow == None:
+            return None
+        return myrow[0]
+
+    def last_seen(self):
+        """
+        Return a dictionary of filename and the time the record was last
+        seen at the source (ISO 8601), for records not deleted.
+        """
+        with self.lock:
+            mycursor = self.conn.execute("""SELECT filename, MAX(last_seen)
+                FROM records WHERE deleted=0 AND filename IS NOT NULL
+                AND last_seen IS NOT NULL GROUP BY filename""")
+            return dict(mycursor.fetchall())
+
+    def datestamps(self):
+        """
+        Return a dictionary of identifier and datestamp of records not
+        deleted.
+        """
+        with self.lock:
+            mycursor = self.conn.execute(
+                    "SELECT identifier, datestamp FROM records WHERE deleted=0")
+            return dict(mycursor.fetchall())
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
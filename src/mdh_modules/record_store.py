@@ -0,0 +1,394 @@
+"""
+PURPOSE:
+    Storage of records (raw harvested records and MMD records) on disk.
+    Records are identified by their file name (e.g. <id>.xml) and stored
+    in a directory, either flat, sharded or packed. In the sharded layout
+    records are kept in subdirectories named by the first two hexadecimal
+    digits of the SHA-1 of the file name, keeping directories small for
+    sources with many records. In the packed layout records are kept
+    compressed in a single SQLite database in the directory, avoiding one
+    file per record.
+
+    All tools access records through get_store, i.e. the layout is only
+    decided once per directory. The stores share one interface: names,
+    exists, mtime, read, parse, write, delete, items, commit, compact and
+    close.
+
+NOTES:
+    - The layout of a directory is recorded in .mdharvest-layout in the
+      directory. Directories without this file are flat.
+    - The layout requested (configuration key layout) is only applied to
+      directories without records, existing directories are converted
+      using migrate-layout.py.
+    - Records in a packed store still have a path (as if flat), used as
+      file name in the index of harvested records and in log messages.
+      Use export-records.py to write them to files.
+    - Writes to a packed store are visible to the same process at once,
+      but only stored permanently on commit or close.
+    - The time records are written to a packed store is kept as their
+      modification time.
+
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import sqlite3
+import zlib
+import time
+import lxml.etree as ET
+
+LAYOUT_NAME = '.mdharvest-layout'
+LAYOUTS = ['flat', 'sharded', 'packed']
+RECORD_SUFFIX = '.xml'
+# Files kept next to records (e.g. MM2 XMD files), moved with them
+COMPANION_SUFFIXES = ['.xmd']
+PACK_NAME = '.mdharvest-records.sqlite'
+# Number of names read at a time when iterating a packed store
+BATCH_SIZE = 1000
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def shard(name):
+    """ Subdirectory of a record in the sharded layout """
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:2]
+
+def read_layout(directory):
+    """ Layout of a directory, None if not recorded """
+    try:
+        with open(os.path.join(directory, LAYOUT_NAME), 'r') as myfile:
+            return myfile.read().strip()
+    except FileNotFoundError:
+        return None
+
+def write_layout(directory, layout):
+    """ Record the layout of a directory """
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout: %s' % layout)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LAYOUT_NAME), 'w') as myfile:
+        myfile.write(layout+'\n')
+
+def get_store(directory, layout=None):
+    """
+    Return the store of a directory, shared by all users in the process.
+    layout is applied if the directory has no records yet.
+    """
+    mykey = os.path.abspath(directory)
+    with _stores_lock:
+        if mykey not in _stores:
+            _stores[mykey] = open_store(directory, layout)
+        return _stores[mykey]
+
+def open_store(directory, layout=None):
+    """ Create the store of a directory, according to its layout """
+    mystore = DirectoryStore(directory, layout)
+    if mystore.layout == 'packed':
+        return PackedStore(directory)
+    return mystore
+
+def close_stores():
+    """ Commit and close all stores opened through get_store """
+    with _stores_lock:
+        for mystore in _stores.values():
+            mystore.close()
+        _stores.clear()
+
+def move_companions(oldpath, newpath):
+    """
+    Move the files kept next to a record (see COMPANION_SUFFIXES) with
+    the record. Packed records keep them at their flat path.
+    """
+    if oldpath == newpath:
+        return
+    for mysuffix in COMPANION_SUFFIXES:
+        myold = oldpath[:-len(RECORD_SUFFIX)]+mysuffix
+        if os.path.exists(myold):
+            os.replace(myold, newpath[:-len(RECORD_SUFFIX)]+mysuffix)
+
+def migrate_store(directory, layout):
+    """
+    Move the records of a directory to another layout. Returns a
+    dictionary of the file names moved and their new path. Records already
+    moved are left as they are, i.e. an interrupted migration can be
+    repeated. Companion files (e.g. .xmd) are moved before their records.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout: %s' % layout)
+    with _stores_lock:
+        mystore = _stores.pop(os.path.abspath(directory), None)
+    if mystore != None:
+        mystore.close()
+    mysource = open_store(directory)
+    moved = {}
+    if mysource.layout != layout:
+        if layout == 'packed':
+            mytarget = PackedStore(directory)
+        else:
+            mytarget = DirectoryStore(directory)
+            mytarget.layout = layout
+        if mysource.layout == 'packed':
+            # Records already moved are removed from the pack
+            for name in list(mysource.names()):
+                move_companions(mysource.path(name), mytarget.path(name, create=True))
+                mytarget.write(name, mysource.read(name))
+                mysource.delete(name)
+                moved[name] = mytarget.path(name)
+            mysource.close()
+            os.remove(mysource.filename)
+        elif layout == 'packed':
+            # Files are removed once their records are committed
+            mypending = []
+            for name, oldpath in list(mysource.paths()):
+                move_companions(oldpath, mytarget.path(name))
+                mytarget.write(name, mysource.read(name))
+                mypending.append(oldpath)
+                moved[name] = mytarget.path(name)
+                if len(mypending) >= BATCH_SIZE:
+                    mytarget.commit()
+                    for mypath in mypending:
+                        os.remove(mypath)
+                    mypending = []
+            mytarget.commit()
+            for mypath in mypending:
+                os.remove(mypath)
+        else:
+            # List before moving, as moving changes the directories listed
+            for name, oldpath in list(mysource.paths()):
+                newpath = mytarget.path(name, create=True)
+                move_companions(oldpath, newpath)
+                os.replace(oldpath, newpath)
+                moved[name] = newpath
+        mytarget.close()
+        write_layout(directory, layout)
+        if mysource.layout == 'sharded':
+            # Remove the shard directories, if empty
+            for myentry in os.scandir(directory):
+                if myentry.is_dir() and len(myentry.name) == 2:
+                    try:
+                        os.rmdir(myentry.path)
+                    except OSError:
+                        pass
+    return moved
+
+class DirectoryStore(object):
+    """
+    Records stored as files in a directory.
+    """
+    def __init__(self, directory, layout=None):
+        self.directory = directory
+        self.layout = 'flat'
+        mylayout = read_layout(directory)
+        if mylayout == None:
+            mylayout = 'flat'
+            if layout not in [None, 'flat']:
+                if any(True for x in self.names()):
+                    logging.getLogger(__name__).warning(
+                            "%s holds records, use migrate-layout.py to change layout to %s",
+                            directory, layout)
+                else:
+                    write_layout(directory, layout)
+                    mylayout = layout
+        if mylayout not in LAYOUTS:
+            raise ValueError('Unknown layout in %s: %s' % (directory, mylayout))
+        self.layout = mylayout
+
+    def path(self, name, create=False):
+        """
+        Path of the record name (file name). If create is set, the
+        directory is created if needed, i.e. when writing.
+        """
+        if self.layout == 'sharded':
+            mydir = os.path.join(self.directory, shard(name))
+        else:
+            mydir = self.directory
+        if create and not os.path.isdir(mydir):
+            os.makedirs(mydir, exist_ok=True)
+        return os.path.join(mydir, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def mtime(self, name):
+        """ Modification time of a record, None if not stored """
+        try:
+            return os.stat(self.path(name)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def read(self, name):
+        """ Content of a record, raises KeyError if not stored """
+        try:
+            with open(self.path(name), 'rb') as myfile:
+                return myfile.read()
+        except FileNotFoundError:
+            raise KeyError(name)
+
+    def parse(self, name, parser=None):
+        """ Parse a record, returns an ElementTree """
+        if not self.exists(name):
+            raise KeyError(name)
+        return ET.parse(self.path(name), parser)
+
+    def write(self, name, data):
+        """ Store the content (bytes) of a record """
+        with open(self.path(name, create=True), 'wb') as myfile:
+            myfile.write(data)
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def names(self, suffix=RECORD_SUFFIX):
+        """
+        Iterate over the file names of the records stored, without
+        listing the whole directory in memory.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        if self.layout == 'flat':
+            mydirs = [self.directory]
+        else:
+            mydirs = (x.path for x in os.scandir(self.directory)
+                    if x.is_dir() and len(x.name) == 2)
+        for mydir in mydirs:
+            with os.scandir(mydir) as myentries:
+                for myentry in myentries:
+                    if myentry.name.endswith(suffix) and myentry.is_file():
+                        yield myentry.name
+
+    def paths(self, suffix=RECORD_SUFFIX):
+        """ Iterate over the file names and paths of the records stored """
+        for name in self.names(suffix):
+            yield name, self.path(name)
+
+    def items(self, suffix=RECORD_SUFFIX):
+        """ Iterate over the file names and content of the records stored """
+        for name, mypath in self.paths(suffix):
+            with open(mypath, 'rb') as myfile:
+                yield name, myfile.read()
+
+    def commit(self):
+        pass
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+class PackedStore(object):
+    """
+    Records stored compressed in a SQLite database in a directory. Access
+    is serialised, i.e. instances can be shared by threads.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.layout = 'packed'
+        self.filename = os.path.join(directory, PACK_NAME)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS records (
+            name TEXT PRIMARY KEY,
+            data BLOB,
+            mtime REAL)""")
+        mycolumns = [x[1] for x in self.conn.execute("PRAGMA table_info(records)")]
+        if 'mtime' not in mycolumns:
+            self.conn.execute("ALTER TABLE records ADD COLUMN mtime REAL")
+        self.conn.commit()
+
+    def path(self, name, create=False):
+        """ Path of the record if it was stored flat """
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM records WHERE name=?",
+                    (name,)).fetchone() != None
+
+    def mtime(self, name):
+        """ Time a record was written, None if not stored or not known """
+        with self.lock:
+            myrow = self.conn.execute("SELECT mtime FROM records WHERE name=?",
+                    (name,)).fetchone()
+        if myrow == None:
+            return None
+        return myrow[0]
+
+    def read(self, name):
+        """ Content of a record, raises KeyError if not stored """
+        with self.lock:
+            myrow = self.conn.execute("SELECT data FROM records WHERE name=?",
+                    (name,)).fetchone()
+        if myrow == None:
+            raise KeyError(name)
+        return zlib.decompress(myrow[0])
+
+    def parse(self, name, parser=None):
+        """ Parse a record, returns an ElementTree """
+        return ET.ElementTree(ET.fromstring(self.read(name), parser))
+
+    def write(self, name, data):
+        """ Store the content (bytes) of a record """
+        mydata = zlib.compress(data)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO records (name, data, mtime) VALUES (?, ?, ?)",
+                    (name, mydata, time.time()))
+
+    def delete(self, name):
+        with self.lock:
+            self.conn.execute("DELETE FROM records WHERE name=?", (name,))
+
+    def names(self, suffix=RECORD_SUFFIX):
+        """
+        Iterate over the names of the records stored, in batches. Records
+        can be written while iterating.
+        """
+        last = ''
+        while True:
+            with self.lock:
+                myrows = self.conn.execute("""SELECT name FROM records
+                    WHERE name > ? ORDER BY name LIMIT ?""",
+                    (last, BATCH_SIZE)).fetchall()
+            if not myrows:
+                return
+            for (name,) in myrows:
+                if name.endswith(suffix):
+                    yield name
+            last = myrows[-1][0]
+
+    def paths(self, suffix=RECORD_SUFFIX):
+        """ Iterate over the names and (flat) paths of the records stored """
+        for name in self.names(suffix):
+            yield name, self.path(name)
+
+    def items(self, suffix=RECORD_SUFFIX):
+        """ Iterate over the names and content of the records stored """
+        for name in self.names(suffix):
+            try:
+                yield name, self.read(name)
+            except KeyError:
+                # Deleted while iterating
+                continue
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def compact(self):
+        """ Reclaim the space left by records replaced or deleted """
+        with self.lock:
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            if self.conn != None:
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,153 @@
+"""
+PURPOSE:
+    Manifest of the records transformed to MMD, used by xmltransform.py
+    to transform new and changed records only. For each raw record the
+    checksum (SHA-256) and modification time of the version transformed
+    are kept, together with the settings of the transformation
+    (stylesheet and collections). Records are transformed again if the
+    raw record is newer than the MMD record, if its checksum changed, or
+    if the settings changed. When converting MM2 (xmltransform.py -x) the
+    checksum and modification time of the XMD file are kept too, as it is
+    an input to the transformation.
+
+NOTES:
+    - The manifest is a SQLite database in the MMD directory of the
+      source.
+    - Raw records with the same modification time as in the manifest are
+      not read, i.e. the checksum is only calculated for records that may
+      have changed. Records packed before the modification time was kept
+      have none and are always read.
+    - Stylesheets included or imported by the stylesheet are not part of
+      the settings, remove the manifest if these are changed.
+    - MMD records without a raw record are listed, one per line, in
+      .mdharvest-orphans.txt in the MMD directory.
+    - Records set inactive (setInactiveRecord) lose their checksum in the
+      manifest, i.e. they are transformed again (and active) once the raw
+      record is written again.
+
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+
+MANIFEST_NAME = '.mdharvest-transform.sqlite'
+ORPHANS_NAME = '.mdharvest-orphans.txt'
+
+def manifest_filename(mmdDir):
+    """
+    Name of the manifest belonging to a MMD directory.
+    """
+    return os.path.join(mmdDir, MANIFEST_NAME)
+
+def orphans_filename(mmdDir):
+    """
+    Name of the list of MMD records without a raw record in a MMD
+    directory.
+    """
+    return os.path.join(mmdDir, ORPHANS_NAME)
+
+def transform_settings(stylesheet, collections=None, xflg=False):
+    """
+    Return a checksum of the settings of a transformation.
+    """
+    mysum = hashlib.sha256()
+    with open(stylesheet, 'rb') as myfile:
+        mysum.update(myfile.read())
+    mysum.update(('\n%s\n%s' % (collections or '', bool(xflg))).encode('utf-8'))
+    return mysum.hexdigest()
+
+def checksum(data):
+    """ Checksum of the content (bytes) of a raw record or XMD file """
+    return hashlib.sha256(data).hexdigest()
+
+def mark_inactive(mmdDir, name):
+    """
+    Register that the MMD record name was set inactive, if the directory
+    has a manifest.
+    """
+    if not os.path.exists(manifest_filename(mmdDir)):
+        return
+    mymanifest = TransformManifest(manifest_filename(mmdDir))
+    mymanifest.mark_inactive([name])
+    mymanifest.close()
+
+class TransformManifest(object):
+    """
+    Persistent manifest of transformed records. Records transformed with
+    other settings are forgotten when opened, unless settings is None.
+    """
+    def __init__(self, filename, settings=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        mydir = os.path.dirname(filename)
+        if mydir and not os.path.isdir(mydir):
+            os.makedirs(mydir, exist_ok=True)
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS records (
+            name TEXT PRIMARY KEY,
+            checksum TEXT,
+            mtime REAL,
+            xmdsum TEXT,
+            xmdtime REAL)""")
+        mycolumns = [x[1] for x in self.conn.execute("PRAGMA table_info(records)")]
+        for mycol, mytype in [('xmdsum', 'TEXT'), ('xmdtime', 'REAL')]:
+            if mycol not in mycolumns:
+                self.conn.execute("ALTER TABLE records ADD COLUMN %s %s" % (mycol, mytype))
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT)""")
+        myrow = self.conn.execute(
+                "SELECT value FROM settings WHERE key='transform'").fetchone()
+        self.changed = settings != None and (myrow == None or myrow[0] != settings)
+        if self.changed:
+            self.conn.execute("DELETE FROM records")
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('transform', ?)",
+                    (settings,))
+        self.conn.commit()
+
+    def entries(self):
+        """
+        Return a dictionary of name and (checksum, mtime, xmdsum, xmdtime)
+        of the records transformed.
+        """
+        with self.lock:
+            mycursor = self.conn.execute(
+                    "SELECT name, checksum, mtime, xmdsum, xmdtime FROM records")
+            return dict((x[0], tuple(x[1:])) for x in mycursor)
+
+    def update(self, name, checksum, mtime, xmdsum=None, xmdtime=None):
+        """
+        Register the version of a raw record (and XMD file) transformed.
+        """
+        with self.lock:
+            self.conn.execute("""INSERT OR REPLACE INTO records
+                (name, checksum, mtime, xmdsum, xmdtime) VALUES (?, ?, ?, ?, ?)""",
+                (name, checksum, mtime, xmdsum, xmdtime))
+
+    def mark_inactive(self, names):
+        """
+        Forget the checksum of records set inactive, they are transformed
+        again when the raw record is written again.
+        """
+        with self.lock:
+            self.conn.executemany("UPDATE records SET checksum=NULL WHERE name=?",
+                    ((x,) for x in names))
+
+    def remove(self, names):
+        """
+        Forget records, e.g. when the raw record is removed.
+        """
+        with self.lock:
+            self.conn.executemany("DELETE FROM records WHERE name=?",
+                    ((x,) for x in names))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+PURPOSE:
+    Convert the raw and MMD directories of the sources in a configuration
+    file between the flat, sharded and packed layout. The index of
+    harvested records is updated with the new location of the raw files.
+    Packed stores can also be compacted, reclaiming the space of records
+    replaced or deleted.
+
+NOTES:
+    - Records (.xml) are moved together with their XMD files (.xmd),
+      XMD files of packed records are kept in the directory itself.
+    - Use export-records.py to get the records of a packed store as
+      files without converting it.
+    - Set the configuration key layout accordingly to keep new
+      directories in the same layout.
+    - The migration can be repeated if interrupted.
+
+"""
+
+import sys
+import os
+import argparse
+import yaml
+from mdh_modules.harvest_metadata import initialise_logger
+from mdh_modules.record_index import RecordIndex, index_filename
+from mdh_modules.record_store import LAYOUTS, migrate_store, get_store, close_stores
+import logging
+from logging.handlers import TimedRotatingFileHandler
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-c","--config",dest="cfgfile", help="Configuration file containing endpoints to harvest", required=True)
+    parser.add_argument("-l","--logfile",dest="logfile", help="Log file", required=True)
+    parser.add_argument('-s','--sources',dest='sources',help='Comma separated list of sources (in config) to convert',required=False)
+    parser.add_argument('--layout',dest='layout',choices=LAYOUTS,help='Layout to convert to',required=False)
+    parser.add_argument('--compact',dest='compact',action='store_true',help='Compact packed stores',required=False)
+    parser.add_argument('--dirs',dest='dirs',default='raw,mmd',help='Comma separated list of directories to convert (raw, mmd)',required=False)
+
+    args = parser.parse_args()
+
+    if args.layout is None and not args.compact:
+        parser.error('Either --layout or --compact is required')
+
+    return args
+
+def migrate_directory(mydir, layout, mylog):
+    """
+    Convert a directory, updating the index of harvested records if
+    found.
+    """
+    if not os.path.isdir(mydir):
+        mylog.warning('%s does not exist, skipping', mydir)
+        return
+    moved = migrate_store(mydir, layout)
+    mylog.info('Moved %d records in %s', len(moved), mydir)
+    if moved and os.path.exists(index_filename(mydir)):
+        myindex = RecordIndex(index_filename(mydir))
+        counter = 0
+        for identifier, filename in myindex.files():
+            name = os.path.basename(filename)
+            if name in moved:
+                myindex.set_filename(identifier, moved[name])
+                counter += 1
+        myindex.close()
+        mylog.info('Updated %d records in index', counter)
+
+    return
+
+###########################################################
+def main(argv):
+    # Parse command line arguments
+    try:
+        args = parse_arguments()
+    except:
+        raise SystemExit('Command line arguments didn\'t parse correctly.')
+
+    if args.sources:
+        mysources = args.sources.split(',')
+
+    # Set up logging
+    mylog = initialise_logger(args.logfile,'migrate-layout')
+    mylog.info('\n==========\nConfiguration of logging is finished.')
+
+    # Read config file
+    mylog.info("Reading configuration from: %s", args.cfgfile)
+    with open(args.cfgfile, 'r') as ymlfile:
+        cfg = yaml.full_load(ymlfile)
+
+    for section in cfg:
+        if args.sources:
+            if section not in mysources:
+                continue
+        for name in args.dirs.split(','):
+            mydir = cfg[section][name]
+            if args.layout:
+                mylog.info('Converting %s to %s layout', mydir, args.layout)
+                migrate_directory(mydir, args.layout, mylog)
+            if args.compact and os.path.isdir(mydir):
+                mystore = get_store(mydir)
+                if mystore.layout == 'packed':
+                    mylog.info('Compacting %s', mydir)
+                    mystore.compact()
+    close_stores()
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
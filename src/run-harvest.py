@@ -19,7 +19,53 @@ UPDATED:
         Added logging and corrected some bugs. Improved error handling and selective harvesting.
 
 NOTES:
-    - NA
+    - Optional configuration keys per source:
+        - stream, pipeline, writers, prefetch: OAI-PMH paging strategy
+        - concurrency: number of CSW and OpenSearch pages fetched in
+          parallel
+        - username, password: basic authentication (OpenSearch)
+        - incremental: harvest CSW records modified since the last
+          successful harvest only (constraint on Modified), falling back
+          to a full harvest if not supported. All records are then listed
+          (elementSetName brief) to find records removed.
+        - query: OpenSearch search parameters, default q=*
+        - timeout, verify: HTTP timeout and TLS certificate verification
+        - retries, rate, burst: retries of temporary failures (honouring
+          Retry-After) and requests per second allowed towards the host
+        - selective: harvest new and changed records only, listed using
+          ListIdentifiers (OAI-PMH) or elementSetName summary (CSW), and
+          retrieved using GetRecord or GetRecordById (using concurrency
+          workers). Records no longer listed by CSW are set inactive.
+        - batch: number of records per GetRecordById request, default 50
+        - transform: transform new and changed records to MMD while
+          harvesting, i.e. xmltransform.py is not needed for the source.
+          Collections are added as in xmltransform.py. Unchanged records
+          are transformed again if the stylesheet or collections change.
+        - archive: write raw records, true (default), async (by a
+          separate thread) or false. Not archiving raw records leaves
+          check4outdated.py without records to check. Requires transform
+          (and a stylesheet for mdkw), otherwise the source fails.
+        - layout: flat (default), sharded or packed layout of new raw and
+          MMD directories, see mdh_modules/record_store.py
+    - Sources are harvested concurrently with --workers, limited per host
+      by --host-limit. The configuration key priority (default 0) decides
+      the order, higher values are started first.
+    - OAI-PMH sources (and CSW sources configured as incremental) are
+      harvested incrementally from the start of the last successful
+      harvest (stored in the state file), unless --from or --full is
+      given.
+    - The paging position is stored in the state file after each page
+      written. With --resume an interrupted harvest continues from there,
+      if the resumptionToken has expired the harvest is restarted using
+      the same from argument as the interrupted harvest.
+    - Performance metrics per page and per source are written as JSON
+      lines with --metrics (appended) and as a Prometheus textfile with
+      --prometheus, see mdh_modules/harvest_metrics.py.
+    - With --capture all pages received are stored in a new capture
+      archive (capture-<time> below the directory given). With --replay
+      the requests of a capture are repeated reading the pages from the
+      archive instead of the network, the harvest state is not used nor
+      updated. See mdh_modules/page_capture.py.
 
 """
 
@@ -28,9 +74,17 @@ import os
 import argparse
 import yaml
 from mdh_modules.harvest_metadata import *
+from mdh_modules.harvest_state import HarvestState, state_filename, format_from, SECONDS_GRANULARITY
+from mdh_modules.harvest_metrics import MetricsWriter
+from mdh_modules.page_capture import CaptureArchive
+from mdh_modules.record_store import close_stores
+from mdh_modules.mmd_transform import get_transform, get_stylesheet
+from mdh_modules.transform_manifest import transform_settings
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -39,9 +93,25 @@ def parse_arguments():
     parser.add_argument("-l","--logfile",dest="logfile", help="Log file", required=True)
     parser.add_argument("-f","--from",dest="fromTime", help="DateTime to  harvest fromday in the form YYYY-MM-DD", required=False)
     parser.add_argument('-s','--sources',dest='sources',help='Comma separated list of sources (in config) to harvest',required=False)
+    parser.add_argument('-w','--workers',dest='workers',type=int,default=1,help='Number of sources to harvest concurrently',required=False)
+    parser.add_argument('--full',dest='full',action='store_true',help='Full harvest, ignore the time of the last harvest',required=False)
+    parser.add_argument('--resume',dest='resume',action='store_true',help='Continue interrupted harvests from the last page written',required=False)
+    parser.add_argument('--state',dest='statefile',help='File holding the state of previous harvests, default is next to the configuration file',required=False)
+    parser.add_argument('--host-limit',dest='hostlimit',type=int,default=1,help='Number of sources to harvest concurrently from the same host',required=False)
+    parser.add_argument('--metrics',dest='metricsfile',help='File to append performance metrics to (JSON lines)',required=False)
+    parser.add_argument('--prometheus',dest='promfile',help='Prometheus textfile to write performance metrics to',required=False)
+    parser.add_argument('--capture',dest='capturedir',help='Directory to store captures of the pages harvested in',required=False)
+    parser.add_argument('--replay',dest='replay',help='Capture to replay instead of harvesting',required=False)
 
     args = parser.parse_args()
 
+    if args.capturedir and args.replay:
+        parser.error('--capture and --replay can not be combined')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.hostlimit < 1:
+        parser.error('--host-limit must be at least 1')
+
     if args.fromTime:
         try:
             datetime.strptime(args.fromTime,'%Y-%m-%d')
@@ -54,6 +124,274 @@ def parse_arguments():
 
     return args
 
+def create_request(section, cfgsec, fromTime=None):
+    """
+    Create the initial request for the section depending on protocol.
+    Returns None if the protocol is not supported.
+    """
+    if cfgsec['protocol'] == 'OAI-PMH':
+        if cfgsec['set']:
+            if fromTime:
+                request = "?verb=ListRecords"\
+                        "&metadataPrefix="+cfgsec['mdkw']+\
+                        "&set="+cfgsec['set']+\
+                        "&from="+fromTime
+            else:
+                request = "?verb=ListRecords"\
+                        "&metadataPrefix="+cfgsec['mdkw']+\
+                        "&set="+cfgsec['set'] 
+        else:   
+            if fromTime:
+                request = "?verb=ListRecords"\
+                        "&metadataPrefix="+cfgsec['mdkw']+\
+                        "&from="+fromTime
+            else: 
+                request = "?verb=ListRecords"\
+                        "&metadataPrefix="+cfgsec['mdkw']
+    elif cfgsec['protocol'] == 'OGC-CSW':
+        if section == "EUMETSAT-CSW":
+            request ="?SERVICE=CSW&VERSION=2.0.2"\
+                    "&request=GetRecords" \
+                    "&resultType=results"\
+                    "&outputSchema=http://www.isotc211.org/2005/gmd"\
+                    "&elementSetName=full"
+        elif section == "WGMS":
+            request ="?SERVICE=CSW&VERSION=2.0.2"\
+                    "&request=GetRecords" \
+                    "&constraintLanguage=CQL_TEXT" \
+                    "&typeNames=csw:Record"\
+                    "&resultType=results"\
+                    "&outputSchema=http://www.isotc211.org/2005/gmd" \
+                    "&elementSetName=full"
+        else:
+            request ="?SERVICE=CSW&VERSION=2.0.2"\
+                    "&request=GetRecords" \
+                    "&constraintLanguage=CQL_TEXT" \
+                    "&typeNames=csw:Record"\
+                    "&resultType=results"\
+                    "&outputSchema=http://www.isotc211.org/2005/gmd" \
+                    "&elementSetName=full"
+    elif cfgsec['protocol'] == 'OpenSearch':
+        request = "?"+cfgsec.get('query', 'q=*')
+    else:
+        request = None
+
+    return request
+
+def harvest_section(section, cfgsec, args, state, mylog, metrics=None,
+        capture=None):
+    """
+    Harvest a single section (data centre). Returns a dictionary with
+    number of records, bytes received and wall time. capture is the
+    CaptureArchive to store pages in, or to replay.
+    """
+    mylog.info('\n\n====\nChecking: '+section)
+    start_time = datetime.now()
+    numRec = 0
+    status = 'OK'
+    mystate = state.get(section)
+    mymetrics = None
+    if metrics != None:
+        mymetrics = metrics.source(section, cfgsec['protocol'])
+    mycapture = myreplay = None
+    if capture != None and capture.mode == 'w':
+        mycapture = capture.source(section)
+    elif capture != None:
+        myreplay = capture
+        if myreplay.request(section) == None:
+            mylog.warning("%s is not found in the capture, skipping", section)
+            return {'records': 0, 'bytes': 0,
+                    'walltime': datetime.now()-start_time, 'status': 'Skipped'}
+    mytransform = mysettings = None
+    if cfgsec.get('transform', False):
+        stylesheet = get_stylesheet(cfgsec['mdkw'])
+        if stylesheet == None:
+            mylog.warning("No stylesheet for %s, records of %s are not transformed",
+                    cfgsec['mdkw'], section)
+        else:
+            try:
+                mytransform = get_transform(stylesheet).with_collections(
+                        cfgsec.get('collection'))
+                mysettings = transform_settings(stylesheet, cfgsec.get('collection'))
+            except Exception as e:
+                mylog.error("Could not load stylesheet %s: %s", stylesheet, e)
+                return {'records': 0, 'bytes': 0,
+                        'walltime': datetime.now()-start_time, 'status': 'Failed'}
+    if not cfgsec.get('archive', True) and mytransform == None:
+        mylog.error("%s is neither archived nor transformed, set archive or transform",
+                section)
+        return {'records': 0, 'bytes': 0,
+                'walltime': datetime.now()-start_time, 'status': 'Failed'}
+    mh = MetadataHarvester('run-harvest', cfgsec['source'],
+            None,cfgsec['raw'],cfgsec['mmd'],
+            cfgsec['protocol'],
+            cfgsec['mdkw'],
+            username=cfgsec.get('username'),
+            pw=cfgsec.get('password'),
+            stream=cfgsec.get('stream', False),
+            pipeline=cfgsec.get('pipeline', False),
+            writers=cfgsec.get('writers', 4),
+            prefetch=cfgsec.get('prefetch', 2),
+            concurrency=cfgsec.get('concurrency', 1),
+            timeout=cfgsec.get('timeout', 300),
+            verify=cfgsec.get('verify', False),
+            retries=cfgsec.get('retries', 3),
+            rate=cfgsec.get('rate', None),
+            burst=cfgsec.get('burst', 1),
+            selective=cfgsec.get('selective', False),
+            batchsize=cfgsec.get('batch', 50),
+            transform=mytransform,
+            settings=mysettings,
+            archive=cfgsec.get('archive', True),
+            metrics=mymetrics,
+            capture=mycapture,
+            replay=myreplay,
+            layout=cfgsec.get('layout'))
+
+    # Decide on incremental harvesting, explicit dates take precedence
+    fromTime = args.fromTime
+    granularity = mystate.get('granularity')
+    if myreplay != None:
+        pass
+    elif cfgsec['protocol'] == 'OAI-PMH':
+        if granularity == None:
+            granularity = mh.oaipmh_identify()
+        # Selective harvesting doesn't rely on the from argument
+        if not fromTime and not args.full and not mh.selective and 'last_start' in mystate:
+            fromTime = format_from(mystate['last_start'], granularity)
+    elif cfgsec['protocol'] == 'OGC-CSW':
+        # Optional, as all records are listed to find removed records
+        if not fromTime and not args.full and not mh.selective and cfgsec.get('incremental', False) and 'last_start' in mystate:
+            fromTime = format_from(mystate['last_start'], SECONDS_GRANULARITY)
+
+    # Continue an interrupted harvest using the same request
+    harvest_start = datetime.now(timezone.utc)
+    checkpoint = mystate.get('checkpoint')
+    if myreplay == None and args.resume and checkpoint:
+        mylog.info("Resuming interrupted harvest of %s started %s",
+                section, checkpoint['started'])
+        mh.resume = checkpoint['position']
+        if not args.fromTime:
+            fromTime = checkpoint['from']
+        harvest_start = datetime.fromisoformat(checkpoint['started'])
+
+    def save_checkpoint(position):
+        state.update(section, checkpoint={
+            'position': position,
+            'from': fromTime,
+            'started': harvest_start.isoformat(timespec='seconds'),
+            'saved': datetime.now(timezone.utc).isoformat(timespec='seconds')})
+
+    if myreplay != None:
+        # Repeat the captured requests
+        myrequest = myreplay.request(section)
+        mylog.info("Replaying %s captured %s", section, myrequest['time'])
+        mh.baseURL = myrequest['baseURL']
+        mh.records = myrequest['records']
+        mh.resume = myrequest.get('resume')
+        mh.modified = myrequest.get('modified')
+    else:
+        mh.checkpoint = save_checkpoint
+        if fromTime:
+            mylog.info("Harvesting %s incrementally from %s", section, fromTime)
+        mh.records = create_request(section, cfgsec, fromTime)
+        if cfgsec['protocol'] == 'OGC-CSW' and not mh.selective:
+            mh.modified = fromTime
+        if mycapture != None:
+            mycapture.start(mh.baseURL, mh.records, mh.resume, mh.modified)
+
+    try: 
+        numRec = mh.harvest()
+    except Exception as e:
+        mylog.warning("Something went wrong on harvest from "+section)
+        mylog.warning("Exception message: " + str(e))
+        numRec = mh.numRecHarv
+        status = 'Failed'
+    if numRec == None:
+        numRec = mh.numRecHarv
+        status = 'Failed'
+    mylog.info("Number of records harvested "+section+': '+str(numRec))
+
+    if status == 'OK' and myreplay == None:
+        # Don't leave a gap if harvesting from a date later than last time
+        if args.fromTime and args.fromTime > mystate.get('last_start', '')[:10]:
+            state.update(section, granularity=granularity, records=numRec,
+                    complete=mh.complete, checkpoint=None)
+        else:
+            state.update(section,
+                    last_start=harvest_start.isoformat(timespec='seconds'),
+                    granularity=granularity, records=numRec,
+                    complete=mh.complete, checkpoint=None)
+
+    walltime = datetime.now()-start_time
+    if mymetrics != None:
+        mymetrics.finish(numRec, walltime.total_seconds(), status)
+
+    return {'records': numRec, 'bytes': mh.numBytes,
+            'walltime': walltime, 'status': status}
+
+def schedule_harvest(cfg, sections, args, state, mylog, metrics=None,
+        capture=None):
+    """
+    Harvest sections concurrently. At most args.workers sections are
+    harvested at the same time, and at most args.hostlimit towards the
+    same host. Sections with higher priority (configuration key priority,
+    default 0) are started first. Sections failing with an exception are
+    reported as Failed.
+    """
+    workers = args.workers
+    pending = sorted(sections, key=lambda x: cfg[x].get('priority', 0), reverse=True)
+    running = {}
+    hostcount = {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # Start as many sections as the limits allow
+            for section in list(pending):
+                if len(running) >= workers:
+                    break
+                host = urlparse(cfg[section]['source']).hostname
+                if hostcount.get(host, 0) >= args.hostlimit:
+                    continue
+                pending.remove(section)
+                if cfg[section]['protocol'] not in ['OAI-PMH', 'OGC-CSW', 'OpenSearch']:
+                    mylog.warn("The chosen protocol is not supported yet")
+                    continue
+                hostcount[host] = hostcount.get(host, 0)+1
+                myfuture = pool.submit(harvest_section, section, cfg[section],
+                        args, state, mylog, metrics, capture)
+                running[myfuture] = (section, host, datetime.now())
+            if not running:
+                continue
+            done, notdone = wait(running, return_when=FIRST_COMPLETED)
+            for myfuture in done:
+                section, host, start_time = running.pop(myfuture)
+                hostcount[host] -= 1
+                try:
+                    results[section] = myfuture.result()
+                except Exception as e:
+                    # Other sections are harvested anyway
+                    mylog.exception("Harvest of %s failed: %s", section, e)
+                    results[section] = {'records': 0, 'bytes': 0,
+                            'walltime': datetime.now()-start_time,
+                            'status': 'Failed'}
+
+    return results
+
+def print_summary(results, mylog):
+    """
+    Print a summary table of records, bytes and wall time per section.
+    """
+    myformat = '%-30s %10s %14s %14s %8s'
+    lines = [myformat % ('Section', 'Records', 'Bytes', 'Wall time', 'Status')]
+    for section in sorted(results):
+        res = results[section]
+        lines.append(myformat % (section, res['records'], res['bytes'],
+            str(res['walltime']).split('.')[0], res['status']))
+    mylog.info('\n\n====\nHarvest summary:\n%s', '\n'.join(lines))
+
+    return
+
 ###########################################################
 def main(argv):
     # Parse command line arguments
@@ -81,70 +419,49 @@ def main(argv):
         sys.exit(2)
 
     # Each section is a data centre to harvest
+    sections = []
     for section in cfg:
         if args.sources:
             if section not in mysources:
                 continue
-        mylog.info('\n\n====\nChecking: '+section)
-        if cfg[section]['protocol'] == 'OAI-PMH':
-            if cfg[section]['set']:
-                if args.fromTime:
-                    request = "?verb=ListRecords"\
-                            "&metadataPrefix="+cfg[section]['mdkw']+\
-                            "&set="+cfg[section]['set']+\
-                            "&from="+args.fromTime
-                else:
-                    request = "?verb=ListRecords"\
-                            "&metadataPrefix="+cfg[section]['mdkw']+\
-                            "&set="+cfg[section]['set'] 
-            else:   
-                if args.fromTime:
-                    request = "?verb=ListRecords"\
-                            "&metadataPrefix="+cfg[section]['mdkw']+\
-                            "&from="+args.fromTime
-                else: 
-                    request = "?verb=ListRecords"\
-                            "&metadataPrefix="+cfg[section]['mdkw']
-        elif cfg[section]['protocol'] == 'OGC-CSW':
-            if section == "EUMETSAT-CSW":
-                request ="?SERVICE=CSW&VERSION=2.0.2"\
-                        "&request=GetRecords" \
-                        "&resultType=results"\
-                        "&outputSchema=http://www.isotc211.org/2005/gmd"\
-                        "&elementSetName=full"
-            elif section == "WGMS":
-                request ="?SERVICE=CSW&VERSION=2.0.2"\
-                        "&request=GetRecords" \
-                        "&constraintLanguage=CQL_TEXT" \
-                        "&typeNames=csw:Record"\
-                        "&resultType=results"\
-                        "&outputSchema=http://www.isotc211.org/2005/gmd" \
-                        "&elementSetName=full"
-            else:
-                request ="?SERVICE=CSW&VERSION=2.0.2"\
-                        "&request=GetRecords" \
-                        "&constraintLanguage=CQL_TEXT" \
-                        "&typeNames=csw:Record"\
-                        "&resultType=results"\
-                        "&outputSchema=http://www.isotc211.org/2005/gmd" \
-                        "&elementSetName=full"
-        else:
-            mylog.warn("The chosen protocol is not supported yet")
-            continue
-        numRec = 0
-        mh = MetadataHarvester('run-harvest', cfg[section]['source'],
-                request,cfg[section]['raw'],cfg[section]['mmd'],
-                cfg[section]['protocol'],
-                cfg[section]['mdkw'])
-        try: 
-            numRec = mh.harvest()
-        except Exception as e:
-            mylog.warning("Something went wrong on harvest from "+section)
-            mylog.warning("Exception message: " + str(e))
-        mylog.info("Number of records harvested "+section+': '+str(numRec))
+        sections.append(section)
+
+    # Read the state of previous harvests
+    if args.statefile:
+        statefile = args.statefile
+    else:
+        statefile = state_filename(args.cfgfile)
+    mylog.info("Using harvest state in: %s", statefile)
+    state = HarvestState(statefile)
+
+    # Performance metrics
+    metrics = None
+    if args.metricsfile or args.promfile:
+        metrics = MetricsWriter(args.metricsfile, args.promfile)
+
+    # Capture of pages harvested, or capture to replay
+    capture = None
+    if args.capturedir:
+        capturedir = os.path.join(args.capturedir, 'capture-'+
+                datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+        mylog.info("Capturing pages harvested in: %s", capturedir)
+        capture = CaptureArchive(capturedir, 'w')
+    elif args.replay:
+        mylog.info("Replaying capture: %s", args.replay)
+        capture = CaptureArchive(args.replay, 'r')
+
+    try:
+        results = schedule_harvest(cfg, sections, args, state, mylog,
+                metrics, capture)
+    finally:
+        if metrics != None:
+            metrics.close()
+        if capture != None:
+            capture.close()
+        close_stores()
+    print_summary(results, mylog)
 
     sys.exit(0)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
-
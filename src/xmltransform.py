@@ -28,6 +28,14 @@ NOTES:
         - Do we need indir, outdir, parent etc still? Only for MM2/XMD
           conversion?
     - Make methods for both processing of files and modification of XSLTs??
+    - With --workers files are transformed by a pool of processes, each
+      compiling the stylesheet once. Files are handed out in chunks and
+      written by the main process in the order listed, i.e. the output is
+      the same as without workers. Files that can't be transformed are
+      logged and skipped.
+    - With --incremental only new and changed records are transformed, see
+      mdh_modules/transform_manifest.py. MMD records without raw records
+      are listed in .mdharvest-orphans.txt in the MMD directory.
 
 """
 
@@ -35,10 +43,14 @@ import sys
 import os
 import argparse
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 import lxml.etree as ET
-import codecs
 import yaml
 from mdh_modules.harvest_metadata import initialise_logger, check_directories
+from mdh_modules.record_index import RecordIndex, index_filename
+from mdh_modules.record_store import get_store, open_store, close_stores
+from mdh_modules.mmd_transform import get_stylesheet, get_transform, get_mmdid
+from mdh_modules.transform_manifest import TransformManifest, manifest_filename, orphans_filename, transform_settings, checksum
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
@@ -49,6 +61,8 @@ def parse_arguments():
     parser.add_argument("-l","--logfile",dest="logfile", help="Log file", required=True)
     parser.add_argument('-s','--sources',dest='sources',help='Comma separated list of sources (in config) to harvest',required=False)
     parser.add_argument('-x','--xmdfile', dest='xmd',help='Converting MM2 to MMD (need to read XMD files)',action='store_true')
+    parser.add_argument('-i','--incremental',dest='incremental',help='Transform only new and changed records',action='store_true')
+    parser.add_argument('-w','--workers',dest='workers',type=int,default=1,help='Number of processes transforming files',required=False)
 
     args = parser.parse_args()
 
@@ -64,49 +78,187 @@ def create_uuid(infile,lastupdate):
     myuuid = uuid.uuid5(uuid.NAMESPACE_URL,string2use)
     return(myuuid)
 
+# Records given to a worker at a time
+CHUNK_SIZE = 50
+
+# Transformation of the process (set by init_worker)
+_worker = {}
+
+def init_worker(xflg, indir, stylesheet, mycollections, instore=None):
+    """
+    Prepare the transformation of records, in each worker process. The
+    stylesheet is parsed once and compiled on first use.
+    """
+    _worker['xflg'] = xflg
+    # Workers open their own store, connections are not shared by processes
+    _worker['store'] = instore if instore != None else open_store(indir)
+    _worker['transform'] = get_transform(stylesheet).with_collections(mycollections)
+
+def transform_record(myfile):
+    """
+    Transform a record, returns the file name, the MMD record (bytes), its
+    metadata identifier and an error message if failing.
+    """
+    instore = _worker['store']
+    mytransform = _worker['transform']
+    xmlfile = instore.path(myfile)
+    try:
+        if _worker['xflg']:
+            xmdfile = xmlfile.replace('.xml','.xmd')
+            if not os.path.isfile(xmdfile):
+                return myfile, None, None, 'Could not find xmdfile: %s' % xmdfile
+            xmd = ET.parse(xmdfile)
+            xmdlastupdate = xmd.xpath("//ds:info/@datestamp", \
+                    namespaces={'ds':'http://www.met.no/schema/metamod/dataset'})[0]
+            myuuid = create_uuid(xmlfile,xmdlastupdate)
+            inxml = instore.parse(myfile)
+            newxml = mytransform(inxml,
+                xmd=ET.XSLT.strparam(xmdfile),
+                mmdid=ET.XSLT.strparam(str(myuuid)))
+        else:
+            inxml = instore.parse(myfile)
+            newxml = mytransform(inxml)
+        return myfile, ET.tostring(newxml, pretty_print=True), get_mmdid(newxml), None
+    except Exception as e:
+        return myfile, None, None, str(e)
+
+def xmd_version(xmdfile):
+    """ Checksum and modification time of a XMD file, None if missing """
+    try:
+        with open(xmdfile, 'rb') as myfile:
+            return checksum(myfile.read()), os.fstat(myfile.fileno()).st_mtime
+    except FileNotFoundError:
+        return None, None
+
+def select_changed(myfiles, instore, outstore, mymanifest, myseen, mypending,
+        xflg=False):
+    """
+    Return the files to transform again, i.e. new raw records, records
+    (or their XMD file if xflg) changed since transformed and records
+    without a MMD record. The files listed are added to myseen, the
+    checksum and modification time of the files returned to mypending.
+    """
+    myentries = mymanifest.entries()
+    for myfile in myfiles:
+        myseen.add(myfile)
+        myentry = myentries.get(myfile)
+        mymtime = instore.mtime(myfile)
+        mysum = None
+        mychanged = True
+        if myentry != None and outstore.exists(myfile):
+            mmdtime = outstore.mtime(myfile)
+            if mymtime == None or mmdtime == None or mymtime <= mmdtime:
+                # Not newer than the MMD record, transform only if changed
+                if mymtime != None and mymtime == myentry[1]:
+                    mychanged = False
+                else:
+                    mysum = checksum(instore.read(myfile))
+                    mychanged = mysum != myentry[0]
+        # The XMD file is an input to the transformation too
+        xmdsum = xmdtime = None
+        if xflg:
+            xmdfile = instore.path(myfile).replace('.xml','.xmd')
+            try:
+                xmdtime = os.stat(xmdfile).st_mtime
+            except FileNotFoundError:
+                xmdtime = None
+            if mychanged or xmdtime == None or xmdtime != myentry[3]:
+                xmdsum, xmdtime = xmd_version(xmdfile)
+                if not mychanged and xmdsum != myentry[2]:
+                    mychanged = True
+        if not mychanged:
+            if (mysum != None and mymtime != None) or xmdsum != None:
+                # Avoid reading it again in the next run
+                mymanifest.update(myfile, myentry[0], mymtime or myentry[1],
+                        myentry[2], xmdtime if xflg else None)
+            continue
+        if mysum == None:
+            mysum = checksum(instore.read(myfile))
+        mypending[myfile] = (mysum, mymtime, xmdsum, xmdtime)
+        yield myfile
+
 #class ProcessFiles(object):
-def process_files(xflg, myfiles, indir, outdir, mycollections, mytransform):
+def process_files(xflg, myfiles, indir, outdir, mycollections, stylesheet, workers=1,
+        incremental=False):
 
     mylog = logging.getLogger('xmltransform')
-    # Process files
+    instore = get_store(indir)
+    outstore = get_store(outdir)
+    # Register MMD identifiers in the index of harvested records
+    if os.path.exists(index_filename(indir)):
+        myindex = RecordIndex(index_filename(indir))
+    else:
+        myindex = None
+    myfiles = (x for x in myfiles if x.endswith(".xml"))
+    # Transform new and changed records only
+    mymanifest = None
+    if incremental:
+        mymanifest = TransformManifest(manifest_filename(outdir),
+                transform_settings(stylesheet, mycollections, xflg))
+        if mymanifest.changed:
+            mylog.info("Transformation settings changed or not recorded, transforming all records")
+        myseen = set()
+        mypending = {}
+        myfiles = select_changed(myfiles, instore, outstore, mymanifest,
+                myseen, mypending, xflg)
+    # Process files, results are written in the order of the files
+    mypool = None
+    if workers > 1:
+        mypool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                initargs=(xflg, indir, stylesheet, mycollections))
+        myresults = mypool.map(transform_record, myfiles, chunksize=CHUNK_SIZE)
+    else:
+        init_worker(xflg, indir, stylesheet, mycollections, instore)
+        myresults = map(transform_record, myfiles)
     i=1
-    s = "/"
-    for myfile in myfiles:
-        xmlfile = s.join((indir,myfile))
-        mylog.info("Processing file %d: %s",i, xmlfile)
-        if myfile.endswith(".xml"):
-            if xflg:
-                xmdfile = xmlfile.replace('.xml','.xmd')
-                if not os.path.isfile(xmdfile):
-                    mylog.warn('Could not find xmdfile: %s', xmdfile)
-                    continue
-                xmd = ET.parse(xmdfile)
-                xmdlastupdate = xmd.xpath("//ds:info/@datestamp", \
-                        namespaces={'ds':'http://www.met.no/schema/metamod/dataset'})[0]
-                collection = xmd.xpath("//ds:info/@ownertag", \
-                        namespaces={'ds':'http://www.met.no/schema/metamod/dataset'})[0]
-                myuuid = create_uuid(xmlfile,xmdlastupdate)
+    failed = 0
+    try:
+        for myfile, mydata, mmdid, myerror in myresults:
+            xmlfile = instore.path(myfile)
+            mylog.info("Processing file %d: %s",i, xmlfile)
             i += 1
-            inxml = ET.parse(xmlfile)
-            if xflg:
-                newxml = mytransform(inxml,
-                    xmd=ET.XSLT.strparam(xmdfile),
-                    mmdid=ET.XSLT.strparam(str(myuuid)))
-            else:
-                newxml = mytransform(inxml)
-            output = codecs.open(s.join((outdir,myfile)),"w", "utf-8")
-            output.write(ET.tostring(newxml,
-                pretty_print=True).decode('utf-8'))
-            output.close()
+            if myerror != None:
+                mylog.error("Could not transform %s: %s", xmlfile, myerror)
+                failed += 1
+                continue
+            outstore.write(myfile, mydata)
+            if myindex != None and mmdid:
+                myindex.set_mmdid(xmlfile, mmdid)
+            if mymanifest != None:
+                mymanifest.update(myfile, *mypending.pop(myfile))
+        if mymanifest != None:
+            list_orphans(outstore, myseen, mymanifest)
+            mylog.info("%d of %d records transformed", i-1-failed, len(myseen))
+    finally:
+        if mypool != None:
+            mypool.shutdown()
+        if myindex != None:
+            myindex.close()
+        outstore.commit()
+        if mymanifest != None:
+            mymanifest.close()
+    if failed:
+        mylog.warning("%d of %d files could not be transformed", failed, i-1)
 
     return
 
+def list_orphans(outstore, myseen, mymanifest):
+    """
+    List MMD records without a raw record for cleanup, and remove them
+    from the manifest.
+    """
+    mylog = logging.getLogger('xmltransform')
+    myorphans = [x for x in outstore.names() if x not in myseen]
+    mymanifest.remove(x for x in list(mymanifest.entries()) if x not in myseen)
+    with open(orphans_filename(outstore.directory), 'w') as myfile:
+        for myorphan in myorphans:
+            myfile.write(outstore.path(myorphan)+'\n')
+    if myorphans:
+        mylog.warning("%d MMD records without raw records, listed in %s",
+                len(myorphans), orphans_filename(outstore.directory))
+
 def main(argv):
     # This is the main method
-    mydif = ['dif', 'dif_10', 'gcmd']
-    myiso = ['iso','iso19139','iso19115']
-    mydcat = ['rdf']
-
     # Parse command line arguments
     try:
         args = parse_arguments()
@@ -146,16 +298,8 @@ def main(argv):
                 continue
         indir = cfg[section]['raw']
         outdir = cfg[section]['mmd']
-        if cfg[section]['mdkw'] in mydif:
-            stylesheet =  '../xslt/dif-to-mmd.xsl'
-        elif cfg[section]['mdkw'] in myiso:
-            stylesheet =  '../xslt/iso-to-mmd.xsl'
-        elif cfg[section]['mdkw'] in mydcat:
-            stylesheet =  '../xslt/dcat-to-mmd.xsl'
-        elif cfg[section]['mdkw'] in ['MM2']:
-            stylesheet =  '../xslt/mm2-to-mmd.xsl'
-        else:
-            stylesheet = None
+        stylesheet = get_stylesheet(cfg[section]['mdkw'])
+        if stylesheet == None:
             mylog.warning('Check configuration, no stylesheet specified.  Skipping these records') 
             continue
         if cfg[section]['collection']:
@@ -163,46 +307,33 @@ def main(argv):
         else:
             mycollections = None
 
-        # Define stylesheet and modify accordingly
-        parser = ET.XMLParser(remove_blank_text=True)
+        # Compiled once, collections are added to the records transformed
         try:
-            myxslt = ET.parse(stylesheet, parser)
+            mytransform = get_transform(stylesheet)
         except ET.XMLSyntaxError as e:
             mylog.error('XSLT parser error: %s',e)
             sys.exit(1)
-        myroot = myxslt.getroot()
-        # Find the location where to insert element
-        if mycollections:
-            myelement = myxslt.xpath(".//xsl:element[@name='mmd:collection']",
-                    namespaces={
-                        'xsl':'http://www.w3.org/1999/XSL/Transform',
-                        'mmd':'http://www.met.no/schema/mmd'})
-            if len(myelement) == 0:
-                mylog.error("Can't find the requested element, bailing out")
-                sys.exit(2)
-
-            myparent = myelement[0].getparent()
-            for coll in mycollections.split(','):
-                myelem = ET.Element(ET.QName('http://www.w3.org/1999/XSL/Transform','element'),
-                        attrib={'name':'mmd:collection'},
-                        nsmap=myroot.nsmap)
-                myelem.text = coll
-                myparent.insert(myparent.index(myelement[0])+1,myelem)
-        myxslt.write('myfile.xsl',pretty_print=True)
-        mytransform = ET.XSLT(myxslt)
+        try:
+            mytransform.with_collections(mycollections)
+        except ValueError as e:
+            mylog.error("Can't find the requested element, bailing out")
+            sys.exit(2)
 
         # Find files to process
         try:
-            myfiles = os.listdir(indir)
+            myfiles = get_store(indir, cfg[section].get('layout')).names()
+            get_store(outdir, cfg[section].get('layout'))
         except OSError as e:
             mylog.error('Can\'t find the files to process: %s',e)
             sys.exit(1)
 
         # Process files
-        if process_files(args.xmd, myfiles, indir, outdir, mycollections, mytransform):
+        if process_files(args.xmd, myfiles, indir, outdir, mycollections, stylesheet,
+                args.workers, args.incremental):
             mylog.error("Something went wrong processing files")
             sys.exit(2)
 
+    close_stores()
     mylog.info('Transformation completed')
 
 